@@ -3,24 +3,99 @@ Python API server for Cerebras HUD.
 Predicts next tokens and compares with what user actually wrote.
 """
 import os
-from fastapi import FastAPI, HTTPException
+import asyncio
+import hashlib
+import math
+import re
+from collections import Counter
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
 import uvicorn
-import requests
+import httpx
+import numpy as np
+import orjson
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 
 load_dotenv()
 
 CEREBRAS_API_URL = os.environ.get("CEREBRAS_API_URL", "https://api.cerebras.ai/v1/completions")
 CEREBRAS_API_TOKEN = os.environ.get("CEREBRAS_API_TOKEN", "")
+
+# The bearer token is static for the process, so build the headers once
+HEADERS = {
+    "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
+    "Content-Type": "application/json",
+}
 USE_MOCK = os.environ.get("USE_MOCK", "false").lower() == "true"
 
 # Only use mock mode if explicitly enabled (user must set USE_MOCK=true)
 MOCK_MODE = USE_MOCK
 
-app = FastAPI()
+# Shared async client, kept alive across requests so connections get reused
+CLIENT_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+CLIENT = httpx.AsyncClient(http2=True, timeout=30, limits=CLIENT_LIMITS)
+
+
+# Max in-flight Cerebras requests per analysis
+API_CONCURRENCY = 8
+
+# Token-bucket limiter pacing upstream calls. Unlike time.sleep this only
+# suspends the calling coroutine, so other connections keep being served.
+CEREBRAS_QPS = float(os.environ.get("CEREBRAS_QPS", "8"))
+RATE_LIMITER = AsyncLimiter(max_rate=CEREBRAS_QPS, time_period=1)
+
+# Tokenizer pattern: words or individual non-whitespace chars, compiled once
+_TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+# Whether the upstream accepts a list of prompts per request; flipped off the
+# first time the endpoint rejects one so we fall back to per-prefix calls
+BATCH_PROMPTS_SUPPORTED = True
+
+# Recently fetched predictions keyed by hashed prefix. Interactive editing
+# queries the same prefix over and over (pauses, undo/redo, repolls), so
+# cache hits skip the upstream round trip entirely.
+PREDICTION_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=300)
+
+# Recently served /analyze results keyed by code hash, so clients that
+# repoll the same file get an answer without any upstream work
+ANALYZE_CACHE: TTLCache = TTLCache(maxsize=64, ttl=300)
+
+# Scored tokens keyed by (prefix, token) hash. The model's next-token
+# distribution only depends on the prefix, so after an incremental edit
+# every token before the edit point scores identically - we only pay
+# upstream calls for the new bytes.
+SCORE_CACHE: TTLCache = TTLCache(maxsize=16384, ttl=600)
+
+# Normalized next-token distributions keyed by hashed prefix. Saliency
+# recomputes the same baseline (and many perturbed prefixes) across
+# repolls of an unchanged file, so these hit constantly.
+DISTRIBUTION_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=300)
+
+
+def distribution_cache_key(prefix: str) -> bytes:
+    """Cache key for a prefix's next-token distribution."""
+    return hashlib.blake2b(prefix.encode(), digest_size=16).digest()
+
+
+def score_cache_key(prefix: str, token_text: str) -> bytes:
+    """Cache key for a scored (prefix, actual token) pair."""
+    return hashlib.blake2b(
+        (prefix + '\x00' + token_text).encode(), digest_size=16
+    ).digest()
+
+
+def prefix_cache_key(prefix: str, k: int) -> tuple:
+    """Cache key for a (prefix, logprobs count) pair."""
+    return (hashlib.blake2b(prefix.encode(), digest_size=16).digest(), k)
+
+# orjson serializes the token-heavy responses several times faster than
+# stdlib json and handles numpy scalars natively
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -29,62 +104,119 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class TokenProb(BaseModel):
-    token: str
-    logprob: float
 
-class LineProbs(BaseModel):
-    line_number: int
-    tokens: List[TokenProb]
+@app.on_event("startup")
+async def open_client():
+    # Recreate the shared client if a previous shutdown closed it
+    global CLIENT
+    if CLIENT.is_closed:
+        CLIENT = httpx.AsyncClient(http2=True, timeout=30, limits=CLIENT_LIMITS)
 
-class FileProbs(BaseModel):
-    uri: str
-    lines: List[LineProbs]
+
+@app.on_event("shutdown")
+async def close_client():
+    await CLIENT.aclose()
 
 class AnalyzeRequest(BaseModel):
     code: str
     uri: str
 
-def get_next_token_prediction(prefix: str) -> Dict:
+async def get_next_token_prediction(prefix: str, client: httpx.AsyncClient) -> Dict:
     """Get model's top predictions for next token."""
     if MOCK_MODE:
         raise HTTPException(status_code=500, detail="CEREBRAS_API_TOKEN not set")
-    
-    headers = {
-        "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    
+
+    cache_key = prefix_cache_key(prefix, 5)
+    cached = PREDICTION_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
     payload = {
         "model": "llama-3.3-70b",
         "prompt": prefix,
         "max_tokens": 1,
         "logprobs": 5,  # Request top 5 logprobs
     }
-    
-    response = requests.post(CEREBRAS_API_URL, headers=headers, json=payload)
-    
+
+    async with RATE_LIMITER:
+        response = await client.post(
+            CEREBRAS_API_URL, headers=HEADERS, content=orjson.dumps(payload)
+        )
+
     if response.status_code != 200:
         raise HTTPException(
             status_code=response.status_code,
             detail=f"Cerebras API error: {response.text}"
         )
-    
-    return response.json()
-
-def simple_tokenize(code: str) -> List[Dict]:
-    """Simple tokenizer that returns tokens with positions."""
-    import re
-    tokens = []
-    pos = 0
-    # Match words or individual non-whitespace chars
-    for match in re.finditer(r'\w+|[^\w\s]', code):
-        tokens.append({
-            'text': match.group(),
-            'start': match.start(),
-            'end': match.end()
-        })
-    return tokens
+
+    data = orjson.loads(response.content)
+    PREDICTION_CACHE[cache_key] = data
+    return data
+
+
+async def get_batch_token_predictions(prefixes: List[str], client: httpx.AsyncClient) -> Optional[List[Dict]]:
+    """
+    Get predictions for many prefixes in one multi-prompt completion call.
+    Returns one single-choice response dict per prefix (aligned by index),
+    or None if the endpoint rejects list prompts.
+    """
+    global BATCH_PROMPTS_SUPPORTED
+    if not BATCH_PROMPTS_SUPPORTED:
+        return None
+
+    # Serve whatever we can from the cache; only uncached prefixes go upstream
+    results: List[Optional[Dict]] = [
+        PREDICTION_CACHE.get(prefix_cache_key(p, 5)) for p in prefixes
+    ]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if not missing:
+        return results
+
+    payload = {
+        "model": "llama-3.3-70b",
+        "prompt": [prefixes[i] for i in missing],
+        "max_tokens": 1,
+        "logprobs": 5,
+    }
+
+    async with RATE_LIMITER:
+        response = await client.post(
+            CEREBRAS_API_URL, headers=HEADERS, content=orjson.dumps(payload)
+        )
+
+    if response.status_code in (400, 404, 422):
+        # List prompts not supported - remember so we stop trying
+        BATCH_PROMPTS_SUPPORTED = False
+        return None
+
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Cerebras API error: {response.text}"
+        )
+
+    data = orjson.loads(response.content)
+    for j, choice in enumerate(data.get('choices', [])):
+        idx = choice.get('index', j)
+        if idx < len(missing):
+            pos = missing[idx]
+            single = {'choices': [choice]}
+            results[pos] = single
+            PREDICTION_CACHE[prefix_cache_key(prefixes[pos], 5)] = single
+
+    return results
+
+def simple_tokenize(code: str) -> tuple:
+    """
+    Simple tokenizer returning parallel arrays (structure-of-arrays):
+    token texts, start offsets and end offsets.
+    """
+    matches = _TOKEN_RE.findall(code)
+    starts = np.fromiter(
+        (m.start() for m in _TOKEN_RE.finditer(code)), dtype=np.int32
+    )
+    ends = starts + np.fromiter((len(t) for t in matches), dtype=np.int32)
+    return matches, starts, ends
 
 def compute_surprise_rank(actual_token: str, top_logprobs: List[Dict]) -> int:
     """
@@ -115,10 +247,6 @@ def rank_to_logprob(rank: int) -> float:
     else:
         return -0.3   # Rank 1 - confident (green, but not invisible)
 
-import time
-import math
-from typing import Optional
-
 # ============================================================================
 # HUD Feature: Entropy Calculation
 # ============================================================================
@@ -130,57 +258,52 @@ def calculate_entropy_from_logprobs(top_logprobs: List[Dict]) -> float:
     """
     if not top_logprobs:
         return 0.0
-    
-    # Find max logprob for numerical stability
-    max_logprob = max(item.get('logprob', -100) for item in top_logprobs)
-    
-    # Convert to probabilities
-    exps = []
-    for item in top_logprobs:
-        logprob = item.get('logprob', -100)
-        exps.append(math.exp(logprob - max_logprob))
-    
-    total = sum(exps)
-    probs = [e / total for e in exps]
-    
-    # Calculate entropy
-    entropy = 0.0
-    for p in probs:
-        if p > 0:
-            entropy -= p * math.log2(p)
-    
-    return entropy
+
+    lp = np.fromiter(
+        (item.get('logprob', -100) for item in top_logprobs),
+        dtype=np.float64, count=len(top_logprobs)
+    )
+
+    # Softmax with max subtracted for numerical stability
+    e = np.exp(lp - lp.max())
+    p = e / e.sum()
+
+    # Calculate entropy (the epsilon keeps log2 defined for zero probs)
+    return float(-(p * np.log2(p + 1e-12)).sum())
 
 
 def calculate_margin(top_logprobs: List[Dict]) -> float:
     """
     Calculate margin between top-1 and top-2 probabilities.
     margin = p1 - p2
+
+    Assumes the list is already sorted by logprob descending, which is
+    what _fetch_top_logprobs returns - no re-sort here.
     """
     if len(top_logprobs) < 2:
         return 1.0
-    
-    # Sort by logprob descending
-    sorted_probs = sorted(top_logprobs, key=lambda x: x.get('logprob', -100), reverse=True)
-    
-    # Get top 2
-    max_logprob = sorted_probs[0].get('logprob', -100)
-    logprob2 = sorted_probs[1].get('logprob', -100)
-    
+
+    max_logprob = top_logprobs[0].get('logprob', -100)
+    logprob2 = top_logprobs[1].get('logprob', -100)
+
     # Convert to probs (unnormalized is fine for margin ratio)
-    p1 = math.exp(max_logprob)
-    p2 = math.exp(logprob2)
-    
+    p1 = 1.0
+    p2 = math.exp(logprob2 - max_logprob)
+
     # Normalize
     total = p1 + p2
-    return (p1 / total) - (p2 / total) if total > 0 else 0.0
+    return (p1 - p2) / total if total > 0 else 0.0
 
 
 # Closing token sets for autopanic
-CLOSE_TOKENS = {
+CLOSE_TOKENS = frozenset({
     '}', ')', ']', 'end', 'fi', 'done', ';', '\n\n',
     'pass', 'return', 'break', 'continue'
-}
+})
+
+# Hard closing brackets, usable both as a set and a startswith() tuple
+HARD_CLOSE_TOKENS = frozenset({'}', ')', ']'})
+CLOSE_PREFIXES = ('}', ')', ']')
 
 def detect_expecting_close(top_logprobs: List[Dict]) -> tuple[bool, List[str], float]:
     """
@@ -189,41 +312,42 @@ def detect_expecting_close(top_logprobs: List[Dict]) -> tuple[bool, List[str], f
     """
     if not top_logprobs:
         return False, [], 0.0
-    
-    # Convert to probabilities
-    max_logprob = max(item.get('logprob', -100) for item in top_logprobs)
-    exps = []
-    for item in top_logprobs:
-        logprob = item.get('logprob', -100)
-        exps.append(math.exp(logprob - max_logprob))
-    total = sum(exps)
-    
-    close_probs = []
-    total_close_prob = 0.0
-    
-    for i, item in enumerate(top_logprobs):
-        token = item.get('token', '').strip()
-        prob = exps[i] / total if total > 0 else 0
-        
-        # Check if this is a closing token
-        is_close = (
-            token in CLOSE_TOKENS or
-            token.startswith('}') or
-            token.startswith(')') or
-            token.startswith(']') or
-            (token == '\n' and len([t for t in top_logprobs if t.get('token', '').strip() in ['}', ')', ']']]) > 0)
-        )
-        
-        if is_close:
-            close_probs.append((token, prob))
-            total_close_prob += prob
-    
-    # Sort by probability
-    close_probs.sort(key=lambda x: x[1], reverse=True)
+
+    tokens = [item.get('token', '').strip() for item in top_logprobs]
+
+    # One fused softmax pass over the whole top-k
+    lp = np.fromiter(
+        (item.get('logprob', -100) for item in top_logprobs),
+        dtype=np.float64, count=len(top_logprobs)
+    )
+    probs = np.exp(lp - lp.max())
+    probs /= probs.sum()
+
+    # Hoisted out of the loop: whether any hard close bracket is in the top-k
+    has_hard_close = any(t in HARD_CLOSE_TOKENS for t in tokens)
+
+    # Boolean mask of closing tokens, then vectorized probability mass
+    is_close_mask = np.fromiter(
+        (
+            t in CLOSE_TOKENS or
+            t.startswith(CLOSE_PREFIXES) or
+            (t == '\n' and has_hard_close)
+            for t in tokens
+        ),
+        dtype=bool, count=len(tokens)
+    )
+
+    total_close_prob = float(probs[is_close_mask].sum())
+
+    # Sort the (few) close tokens by probability
+    close_probs = sorted(
+        ((tokens[i], float(probs[i])) for i in np.flatnonzero(is_close_mask)),
+        key=lambda x: x[1], reverse=True
+    )
     close_types = [t for t, _ in close_probs[:3]]
-    
+
     top_close = close_probs[0] if close_probs else ('', 0.0)
-    
+
     return total_close_prob > 0.5, close_types, total_close_prob, top_close[0], top_close[1]
 
 
@@ -242,8 +366,95 @@ class CursorRequest(BaseModel):
     cursorChar: int
 
 
+async def _fetch_top_logprobs(prefix: str, k: int = 20) -> List[Dict]:
+    """
+    Fetch top-k next-token logprobs for a prefix from Cerebras.
+    Returns a list of {token, logprob} sorted by logprob descending.
+    """
+    cache_key = prefix_cache_key(prefix, k)
+    cached = PREDICTION_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    payload = {
+        "model": "llama-3.3-70b",
+        "prompt": prefix,
+        "max_tokens": 1,
+        "logprobs": k,
+    }
+
+    async with RATE_LIMITER:
+        response = await CLIENT.post(
+            CEREBRAS_API_URL, headers=HEADERS, content=orjson.dumps(payload)
+        )
+
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Cerebras API error: {response.text}"
+        )
+
+    data = orjson.loads(response.content)
+    choice = data['choices'][0]
+    logprobs_data = choice.get('logprobs', {})
+    top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
+
+    top_list = [
+        {'token': k, 'logprob': v}
+        for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
+    ]
+    PREDICTION_CACHE[cache_key] = top_list
+    return top_list
+
+
+def build_entropy_response(top_list: List[Dict]) -> Dict:
+    """Shape the /entropy payload from a sorted top-logprob list."""
+    entropy = calculate_entropy_from_logprobs(top_list)
+    max_logprob = top_list[0]['logprob'] if top_list else -10
+
+    return {
+        "entropy": entropy,
+        "maxLogprob": max_logprob,
+        "topLogprobs": top_list[:10],  # Return top 10
+        "tokenCount": len(top_list)
+    }
+
+
+def build_ghost_response(top_list: List[Dict]) -> Dict:
+    """Shape the /ghost payload from a sorted top-logprob list."""
+    if len(top_list) < 2:
+        return {
+            "primary": top_list[0] if top_list else {"token": "", "logprob": -10},
+            "secondary": {"token": "", "logprob": -10},
+            "margin": 1.0,
+            "shouldShowGhost": False
+        }
+
+    margin = calculate_margin(top_list[:2])
+
+    return {
+        "primary": top_list[0],
+        "secondary": top_list[1],
+        "margin": margin,
+        "shouldShowGhost": margin < 0.15
+    }
+
+
+def build_autopanic_response(top_list: List[Dict]) -> Dict:
+    """Shape the /autopanic payload from a sorted top-logprob list."""
+    expecting, close_types, confidence, top_token, top_prob = detect_expecting_close(top_list)
+
+    return {
+        "expectingClose": expecting,
+        "closeTypes": close_types,
+        "confidence": confidence,
+        "topCloseToken": top_token,
+        "topCloseProb": top_prob
+    }
+
+
 @app.post("/entropy")
-def get_entropy(req: PrefixRequest):
+async def get_entropy(req: PrefixRequest):
     """
     Get entropy for next token prediction at cursor position.
     Returns entropy in bits and top logprobs.
@@ -260,57 +471,18 @@ def get_entropy(req: PrefixRequest):
             ],
             "tokenCount": 3
         }
-    
+
     try:
-        headers = {
-            "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
-        payload = {
-            "model": "llama-3.3-70b",
-            "prompt": req.prefix,
-            "max_tokens": 1,
-            "logprobs": 20,
-            
-        }
-        
-        response = requests.post(CEREBRAS_API_URL, headers=headers, json=payload)
-        
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Cerebras API error: {response.text}"
-            )
-        
-        data = response.json()
-        choice = data['choices'][0]
-        logprobs_data = choice.get('logprobs', {})
-        top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-        
-        # Convert to list format
-        top_list = [
-            {'token': k, 'logprob': v}
-            for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-        ]
-        
-        entropy = calculate_entropy_from_logprobs(top_list)
-        max_logprob = top_list[0]['logprob'] if top_list else -10
-        
-        return {
-            "entropy": entropy,
-            "maxLogprob": max_logprob,
-            "topLogprobs": top_list[:10],  # Return top 10
-            "tokenCount": len(top_list)
-        }
-        
+        top_list = await _fetch_top_logprobs(req.prefix, 20)
+        return build_entropy_response(top_list)
+
     except Exception as e:
         print(f"Entropy calculation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/ghost")
-def get_ghost(req: PrefixRequest):
+async def get_ghost(req: PrefixRequest):
     """
     Get ghost token suggestion (top-2 predictions and margin).
     """
@@ -321,63 +493,18 @@ def get_ghost(req: PrefixRequest):
             "margin": 0.65,
             "shouldShowGhost": False
         }
-    
+
     try:
-        headers = {
-            "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
-        payload = {
-            "model": "llama-3.3-70b",
-            "prompt": req.prefix,
-            "max_tokens": 1,
-            "logprobs": 5,
-            
-        }
-        
-        response = requests.post(CEREBRAS_API_URL, headers=headers, json=payload)
-        
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Cerebras API error: {response.text}"
-            )
-        
-        data = response.json()
-        choice = data['choices'][0]
-        logprobs_data = choice.get('logprobs', {})
-        top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-        
-        top_list = [
-            {'token': k, 'logprob': v}
-            for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-        ]
-        
-        if len(top_list) < 2:
-            return {
-                "primary": top_list[0] if top_list else {"token": "", "logprob": -10},
-                "secondary": {"token": "", "logprob": -10},
-                "margin": 1.0,
-                "shouldShowGhost": False
-            }
-        
-        margin = calculate_margin(top_list[:2])
-        
-        return {
-            "primary": top_list[0],
-            "secondary": top_list[1],
-            "margin": margin,
-            "shouldShowGhost": margin < 0.15
-        }
-        
+        top_list = await _fetch_top_logprobs(req.prefix, 20)
+        return build_ghost_response(top_list)
+
     except Exception as e:
         print(f"Ghost calculation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/autopanic")
-def get_autopanic(req: PrefixRequest):
+async def get_autopanic(req: PrefixRequest):
     """
     Detect if model expects a closing token (bracket autopanic).
     """
@@ -389,51 +516,59 @@ def get_autopanic(req: PrefixRequest):
             "topCloseToken": "",
             "topCloseProb": 0.0
         }
-    
+
     try:
-        headers = {
-            "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
-        payload = {
-            "model": "llama-3.3-70b",
-            "prompt": req.prefix,
-            "max_tokens": 1,
-            "logprobs": 10,
-            
+        top_list = await _fetch_top_logprobs(req.prefix, 20)
+        return build_autopanic_response(top_list)
+
+    except Exception as e:
+        print(f"Autopanic calculation error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/hud")
+async def get_hud(req: PrefixRequest):
+    """
+    All three HUD signals (entropy, ghost, autopanic) from a single
+    upstream completion, so one keystroke costs one Cerebras call.
+    """
+    if MOCK_MODE:
+        return {
+            "entropy": {
+                "entropy": 2.5,
+                "maxLogprob": -0.5,
+                "topLogprobs": [
+                    {"token": "x", "logprob": -0.5},
+                    {"token": "y", "logprob": -1.2},
+                    {"token": "z", "logprob": -2.0},
+                ],
+                "tokenCount": 3
+            },
+            "ghost": {
+                "primary": {"token": "x", "logprob": -0.3},
+                "secondary": {"token": "y", "logprob": -1.5},
+                "margin": 0.65,
+                "shouldShowGhost": False
+            },
+            "autopanic": {
+                "expectingClose": False,
+                "closeTypes": [],
+                "confidence": 0.0,
+                "topCloseToken": "",
+                "topCloseProb": 0.0
+            }
         }
-        
-        response = requests.post(CEREBRAS_API_URL, headers=headers, json=payload)
-        
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Cerebras API error: {response.text}"
-            )
-        
-        data = response.json()
-        choice = data['choices'][0]
-        logprobs_data = choice.get('logprobs', {})
-        top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-        
-        top_list = [
-            {'token': k, 'logprob': v}
-            for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-        ]
-        
-        expecting, close_types, confidence, top_token, top_prob = detect_expecting_close(top_list)
-        
+
+    try:
+        top_list = await _fetch_top_logprobs(req.prefix, 20)
         return {
-            "expectingClose": expecting,
-            "closeTypes": close_types,
-            "confidence": confidence,
-            "topCloseToken": top_token,
-            "topCloseProb": top_prob
+            "entropy": build_entropy_response(top_list),
+            "ghost": build_ghost_response(top_list),
+            "autopanic": build_autopanic_response(top_list),
         }
-        
+
     except Exception as e:
-        print(f"Autopanic calculation error: {e}")
+        print(f"HUD calculation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -441,108 +576,229 @@ def get_autopanic(req: PrefixRequest):
 # Feature 4: Perturbation-based Saliency
 # ============================================================================
 
-import re
+# Token patterns: identifiers, strings, numbers
+_IDENT_RE = re.compile(r'\b[a-zA-Z_][a-zA-Z0-9_]*\b')
+
 
-def find_candidate_tokens(code: str, cursor_line: int, cursor_char: int) -> List[Dict]:
+def find_candidate_tokens(prefix: str, cursor_line: int, cursor_char: int) -> List[Dict]:
     """
     Find candidate tokens for saliency analysis around cursor.
     Returns list of {line, character, token_text, token_type}
+
+    Only scans the prefix - tokens past the cursor can't influence the
+    next-token prediction, so they'd be wasted API calls.
     """
-    lines = code.split('\n')
-    candidates = []
-    
+    # Line start offsets as character indices - regex matches and the
+    # downstream slicing are all str-based, so byte offsets would drift
+    # on any non-ASCII character in the code
+    line_starts = np.array(
+        [0] + [i + 1 for i, c in enumerate(prefix) if c == '\n'],
+        dtype=np.int64,
+    )
+
     # Look at lines around cursor (context window)
-    start_line = max(0, cursor_line - 5)
-    end_line = min(len(lines), cursor_line + 2)
-    
-    # Token patterns: identifiers, strings, numbers
-    identifier_pattern = re.compile(r'\b[a-zA-Z_][a-zA-Z0-9_]*\b')
-    
-    for line_idx in range(start_line, end_line):
-        line = lines[line_idx]
-        for match in identifier_pattern.finditer(line):
-            # Skip very short tokens
-            if len(match.group()) < 2:
-                continue
-            
-            candidates.append({
-                'line': line_idx + 1,  # 1-indexed
-                'character': match.start(),
-                'token_text': match.group(),
-                'token_type': 'identifier'
-            })
-    
+    start_line = min(max(0, cursor_line - 5), len(line_starts) - 1)
+    region_start = int(line_starts[start_line])
+
+    candidates = []
+    for match in _IDENT_RE.finditer(prefix, region_start):
+        # Skip very short tokens
+        if len(match.group()) < 2:
+            continue
+
+        pos = match.start()
+        line_idx = int(np.searchsorted(line_starts, pos, side='right')) - 1
+        candidates.append({
+            'line': line_idx + 1,  # 1-indexed
+            'character': pos - int(line_starts[line_idx]),
+            'token_text': match.group(),
+            'token_type': 'identifier'
+        })
+
     # Prioritize: function names, variables, then others
     # Sort by distance to cursor
     def distance_to_cursor(cand):
         line_dist = abs(cand['line'] - cursor_line)
         char_dist = abs(cand['character'] - cursor_char) if line_dist == 0 else 0
         return (line_dist, char_dist)
-    
-    candidates.sort(key=distance_to_cursor)
-    return candidates[:15]  # Limit to avoid too many API calls
+
+    # Rare identifiers are the informative perturbations - removing one
+    # of many occurrences of a common name barely moves the prediction.
+    # Rank rare tokens first and keep only the occurrence closest to the
+    # cursor per token_text.
+    freq = Counter(cand['token_text'] for cand in candidates)
+    candidates.sort(key=lambda cand: (freq[cand['token_text']], distance_to_cursor(cand)))
+
+    deduped = []
+    seen_texts = set()
+    for cand in candidates:
+        if cand['token_text'] in seen_texts:
+            continue
+        seen_texts.add(cand['token_text'])
+        deduped.append(cand)
+
+    return deduped[:15]  # Limit to avoid too many API calls
 
 
-def get_next_token_distribution(prefix: str) -> Optional[Dict[str, float]]:
+async def get_next_token_distribution(prefix: str) -> Optional[Dict[str, float]]:
     """Get probability distribution over next token."""
     if MOCK_MODE:
         # Return mock distribution
         return {
-            'x': 0.3, 'y': 0.25, 'z': 0.15, ' ': 0.1, 
+            'x': 0.3, 'y': 0.25, 'z': 0.15, ' ': 0.1,
             '\n': 0.08, '(': 0.05, '=': 0.04, ':': 0.03
         }
-    
+
+    cache_key = distribution_cache_key(prefix)
+    cached = DISTRIBUTION_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        headers = {
-            "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
         payload = {
             "model": "llama-3.3-70b",
             "prompt": prefix,
             "max_tokens": 1,
             "logprobs": 20,
         }
-        
-        response = requests.post(CEREBRAS_API_URL, headers=headers, json=payload)
-        
+
+        async with RATE_LIMITER:
+            response = await CLIENT.post(
+                CEREBRAS_API_URL, headers=HEADERS, content=orjson.dumps(payload)
+            )
+
         if response.status_code != 200:
             return None
-        
-        data = response.json()
-        choice = data['choices'][0]
-        logprobs_data = choice.get('logprobs', {})
-        top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-        
-        # Convert to probabilities
-        items = list(top_logprobs.items())
-        if not items:
-            return None
-        
-        max_logprob = max(v for k, v in items)
-        exps = [(k, math.exp(v - max_logprob)) for k, v in items]
-        total = sum(e for _, e in exps)
-        
-        return {k: e / total for k, e in exps}
-        
+
+        data = orjson.loads(response.content)
+        dist = _choice_to_distribution(data['choices'][0])
+        if dist is not None:
+            DISTRIBUTION_CACHE[cache_key] = dist
+        return dist
+
     except Exception as e:
         print(f"Distribution fetch error: {e}")
         return None
 
 
-def calculate_kl_divergence(p: Dict[str, float], q: Dict[str, float]) -> float:
-    """Calculate KL(P || Q)."""
-    kl = 0.0
-    for token, p_prob in p.items():
-        q_prob = q.get(token, 1e-10)
-        if p_prob > 0:
-            kl += p_prob * math.log(p_prob / q_prob)
-    return kl
+def _choice_to_distribution(choice: Dict) -> Optional[Dict[str, float]]:
+    """Turn one completion choice into a normalized token->prob dict."""
+    logprobs_data = choice.get('logprobs', {})
+    top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
+
+    # Convert to probabilities with one vectorized softmax
+    tokens = list(top_logprobs)
+    if not tokens:
+        return None
+
+    lp = np.fromiter(top_logprobs.values(), dtype=np.float64, count=len(tokens))
+    p = np.exp(lp - lp.max())
+    p /= p.sum()
+
+    return dict(zip(tokens, p.tolist()))
+
+
+async def get_next_token_distributions(prefixes: List[str]) -> Optional[List[Optional[Dict[str, float]]]]:
+    """
+    Get next-token distributions for many prefixes in one multi-prompt
+    call, aligned by index. Returns None if the endpoint rejects list
+    prompts (caller falls back to per-prefix requests).
+    """
+    global BATCH_PROMPTS_SUPPORTED
+    if not prefixes:
+        return []
+    if MOCK_MODE:
+        return [await get_next_token_distribution(p) for p in prefixes]
+    if not BATCH_PROMPTS_SUPPORTED:
+        return None
+
+    # Serve cached prefixes locally; only the rest go upstream
+    results: List[Optional[Dict[str, float]]] = [
+        DISTRIBUTION_CACHE.get(distribution_cache_key(p)) for p in prefixes
+    ]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if not missing:
+        return results
+
+    payload = {
+        "model": "llama-3.3-70b",
+        "prompt": [prefixes[i] for i in missing],
+        "max_tokens": 1,
+        "logprobs": 20,
+    }
+
+    async with RATE_LIMITER:
+        response = await CLIENT.post(
+            CEREBRAS_API_URL, headers=HEADERS, content=orjson.dumps(payload)
+        )
+
+    if response.status_code in (400, 404, 422):
+        # List prompts not supported - remember so we stop trying
+        BATCH_PROMPTS_SUPPORTED = False
+        return None
+
+    if response.status_code != 200:
+        return [None] * len(prefixes)
+
+    data = orjson.loads(response.content)
+    for j, choice in enumerate(data.get('choices', [])):
+        idx = choice.get('index', j)
+        if idx < len(missing):
+            pos = missing[idx]
+            dist = _choice_to_distribution(choice)
+            results[pos] = dist
+            if dist is not None:
+                DISTRIBUTION_CACHE[distribution_cache_key(prefixes[pos])] = dist
+
+    return results
+
+
+def kl_missing_contrib(p: Dict[str, float]) -> float:
+    """KL(P || Q) assuming no P token appears in Q's top-20.
+
+    Both distributions are top-20 truncated, so most baseline tokens hit
+    the 1e-10 floor - that part only depends on P and is computed once
+    per baseline instead of once per candidate.
+    """
+    if not p:
+        return 0.0
+    pv = np.fromiter(p.values(), dtype=np.float64, count=len(p))
+    return float((pv * np.log(np.maximum(pv, 1e-30) / 1e-10)).sum())
+
+
+def calculate_kl_divergence_aligned(
+    baseline_p: np.ndarray,
+    baseline_index: Dict[str, int],
+    q: Dict[str, float],
+    missing_contrib: float,
+) -> float:
+    """KL(P || Q) against a baseline pre-aligned as a probability array
+    plus token->index map, both built once and reused for every
+    candidate. Starts from the all-missing contribution and corrects
+    only tokens present in both top-20 sets (typically ~5 of 20)."""
+    indices = []
+    q_values = []
+    for token, q_prob in q.items():
+        i = baseline_index.get(token)
+        if i is not None:
+            indices.append(i)
+            q_values.append(q_prob)
+
+    if not indices:
+        return missing_contrib
+
+    pv = baseline_p[indices]
+    qv = np.asarray(q_values, dtype=np.float64)
+    delta = float((pv * np.log(1e-10 / np.maximum(qv, 1e-10))).sum())
+    return missing_contrib + delta
 
 
 def remove_token_at(code: str, line: int, char: int, token_text: str) -> str:
-    """Create perturbed code with token removed."""
+    """Create perturbed code with token removed.
+
+    Only used when a caller needs the full perturbed file; the saliency
+    hot path slices the perturbed prefix directly instead.
+    """
     lines = code.split('\n')
     if line < 1 or line > len(lines):
         return code
@@ -557,8 +813,46 @@ def remove_token_at(code: str, line: int, char: int, token_text: str) -> str:
     return '\n'.join(lines)
 
 
+def _build_saliency_inputs(code: str, cursor_line: int, cursor_char: int):
+    """Build the baseline prefix, candidate tokens and perturbed prefixes
+    shared by the blocking and streaming saliency endpoints."""
+    lines = code.split('\n')
+
+    # Build prefix up to cursor
+    if cursor_line < 1:
+        prefix = ""
+    elif cursor_line > len(lines):
+        prefix = code
+    else:
+        prefix_lines = lines[:cursor_line - 1]
+        prefix_lines.append(lines[cursor_line - 1][:cursor_char])
+        prefix = '\n'.join(prefix_lines)
+
+    # Find candidate tokens (prefix only - nothing past the cursor)
+    candidates = find_candidate_tokens(prefix, cursor_line, cursor_char)
+
+    # Absolute offset of each line's first character, computed once. A
+    # candidate only affects the prediction if it sits inside the prefix,
+    # so each perturbed prefix is a single slice of the original - no
+    # full-file split/join per candidate.
+    line_offsets = [0] + [i + 1 for i, c in enumerate(code) if c == '\n']
+
+    perturbed_prefixes = []
+    for candidate in candidates:
+        p = line_offsets[candidate['line'] - 1] + candidate['character']
+        if p < len(prefix):
+            perturbed_prefix = prefix[:p] + prefix[p + len(candidate['token_text']):]
+        else:
+            # Token lies past the cursor; the prefix is unchanged
+            perturbed_prefix = prefix
+
+        perturbed_prefixes.append(perturbed_prefix)
+
+    return prefix, candidates, perturbed_prefixes
+
+
 @app.post("/saliency")
-def get_saliency(req: CursorRequest):
+async def get_saliency(req: CursorRequest):
     """
     Compute perturbation-based saliency for tokens around cursor.
     
@@ -569,23 +863,12 @@ def get_saliency(req: CursorRequest):
     
     High KL = token is salient (important for prediction)
     """
-    # Get cursor position and prefix
-    lines = req.code.split('\n')
-    cursor_line = req.cursorLine
-    cursor_char = req.cursorChar
-    
-    # Build prefix up to cursor
-    if cursor_line < 1:
-        prefix = ""
-    elif cursor_line > len(lines):
-        prefix = req.code
-    else:
-        prefix_lines = lines[:cursor_line - 1]
-        prefix_lines.append(lines[cursor_line - 1][:cursor_char])
-        prefix = '\n'.join(prefix_lines)
-    
+    prefix, candidates, perturbed_prefixes = _build_saliency_inputs(
+        req.code, req.cursorLine, req.cursorChar
+    )
+
     # Get baseline distribution
-    baseline_dist = get_next_token_distribution(prefix)
+    baseline_dist = await get_next_token_distribution(prefix)
     if not baseline_dist:
         # Return empty result on error
         return {
@@ -594,38 +877,40 @@ def get_saliency(req: CursorRequest):
         }
     
     base_entropy = calculate_entropy_from_probs(baseline_dist)
-    
-    # Find candidate tokens
-    candidates = find_candidate_tokens(req.code, cursor_line, cursor_char)
-    
-    # Analyze each candidate
-    results = []
-    
-    for candidate in candidates:
-        # Create perturbed code
-        perturbed_code = remove_token_at(
-            req.code,
-            candidate['line'],
-            candidate['character'],
-            candidate['token_text']
+    # Baseline aligned once as an array + index map; every candidate
+    # below reuses it instead of re-iterating the dict
+    baseline_missing = kl_missing_contrib(baseline_dist)
+    baseline_p = np.fromiter(baseline_dist.values(), dtype=np.float64, count=len(baseline_dist))
+    baseline_index = {token: i for i, token in enumerate(baseline_dist)}
+
+    # Fetch all perturbed prefixes in one multi-prompt call, falling back to
+    # concurrent per-prefix requests if the endpoint rejects list prompts
+    try:
+        perturbed_dists = await get_next_token_distributions(perturbed_prefixes)
+    except Exception as e:
+        print(f"Batch distribution error: {e}")
+        perturbed_dists = None
+
+    if perturbed_dists is None:
+        semaphore = asyncio.Semaphore(API_CONCURRENCY)
+
+        async def fetch_distribution(p: str) -> Optional[Dict[str, float]]:
+            async with semaphore:
+                return await get_next_token_distribution(p)
+
+        perturbed_dists = await asyncio.gather(
+            *(fetch_distribution(p) for p in perturbed_prefixes)
         )
-        
-        # Build perturbed prefix
-        perturbed_lines = perturbed_code.split('\n')
-        if cursor_line <= len(perturbed_lines):
-            perturbed_prefix_lines = perturbed_lines[:cursor_line - 1]
-            perturbed_prefix_lines.append(perturbed_lines[cursor_line - 1][:cursor_char])
-            perturbed_prefix = '\n'.join(perturbed_prefix_lines)
-        else:
-            perturbed_prefix = perturbed_code
-        
-        # Get perturbed distribution
-        perturbed_dist = get_next_token_distribution(perturbed_prefix)
-        
+
+    # Reduce: KL divergence of each perturbation against the baseline
+    results = []
+    for candidate, perturbed_dist in zip(candidates, perturbed_dists):
         if perturbed_dist:
-            # Calculate KL divergence
-            kl = calculate_kl_divergence(baseline_dist, perturbed_dist)
-            
+            # Calculate KL divergence (sparse diff against the baseline)
+            kl = calculate_kl_divergence_aligned(
+                baseline_p, baseline_index, perturbed_dist, baseline_missing
+            )
+
             if kl > 0.001:  # Only include meaningful changes
                 results.append({
                     "line": candidate['line'],
@@ -633,11 +918,7 @@ def get_saliency(req: CursorRequest):
                     "tokenText": candidate['token_text'],
                     "klDivergence": kl
                 })
-        
-        # Rate limiting - small delay between calls
-        if not MOCK_MODE:
-            time.sleep(0.05)
-    
+
     # Sort by KL divergence
     results.sort(key=lambda x: x['klDivergence'], reverse=True)
     
@@ -647,96 +928,236 @@ def get_saliency(req: CursorRequest):
     }
 
 
+@app.post("/saliency/stream")
+async def get_saliency_stream(req: CursorRequest):
+    """
+    Stream saliency results as Server-Sent Events.
+
+    Each candidate is emitted as a `data:` event the moment its KL is
+    known, so the client can highlight high-KL tokens immediately
+    instead of waiting for the slowest candidate. A final `event: done`
+    carries the sorted top-10 (same shape as /saliency) to reconcile.
+    """
+    prefix, candidates, perturbed_prefixes = _build_saliency_inputs(
+        req.code, req.cursorLine, req.cursorChar
+    )
+
+    async def event_stream():
+        baseline_dist = await get_next_token_distribution(prefix)
+        if not baseline_dist:
+            payload = {"tokens": [], "baseEntropy": 0.0}
+            yield b"event: done\ndata: " + orjson.dumps(payload) + b"\n\n"
+            return
+
+        base_entropy = calculate_entropy_from_probs(baseline_dist)
+        baseline_missing = kl_missing_contrib(baseline_dist)
+        baseline_p = np.fromiter(baseline_dist.values(), dtype=np.float64, count=len(baseline_dist))
+        baseline_index = {token: i for i, token in enumerate(baseline_dist)}
+
+        semaphore = asyncio.Semaphore(API_CONCURRENCY)
+
+        async def score_candidate(candidate, perturbed_prefix):
+            async with semaphore:
+                perturbed_dist = await get_next_token_distribution(perturbed_prefix)
+            if not perturbed_dist:
+                return None
+
+            kl = calculate_kl_divergence_aligned(
+                baseline_p, baseline_index, perturbed_dist, baseline_missing
+            )
+            if kl <= 0.001:  # Only include meaningful changes
+                return None
+
+            return {
+                "line": candidate['line'],
+                "character": candidate['character'],
+                "tokenText": candidate['token_text'],
+                "klDivergence": kl
+            }
+
+        tasks = [
+            asyncio.create_task(score_candidate(candidate, perturbed_prefix))
+            for candidate, perturbed_prefix in zip(candidates, perturbed_prefixes)
+        ]
+
+        results = []
+        for future in asyncio.as_completed(tasks):
+            result = await future
+            if result:
+                results.append(result)
+                yield b"data: " + orjson.dumps(result) + b"\n\n"
+
+        results.sort(key=lambda x: x['klDivergence'], reverse=True)
+        payload = {"tokens": results[:10], "baseEntropy": base_entropy}
+        yield b"event: done\ndata: " + orjson.dumps(payload) + b"\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 def calculate_entropy_from_probs(probs: Dict[str, float]) -> float:
     """Calculate entropy from probability distribution."""
-    entropy = 0.0
-    for p in probs.values():
-        if p > 0:
-            entropy -= p * math.log2(p)
-    return entropy
+    if not probs:
+        return 0.0
+    pv = np.fromiter(probs.values(), dtype=np.float64, count=len(probs))
+    return float(-(pv * np.log2(pv + 1e-30)).sum())
 
 
-def analyze_with_predictions(code: str, uri: str) -> FileProbs:
+async def analyze_with_predictions(code: str, uri: str) -> Dict:
     """
     Analyze code by comparing each token to model's predictions.
     """
-    tokens = simple_tokenize(code)
+    texts, starts, ends = simple_tokenize(code)
     lines = code.split('\n')
-    
-    # Build result structure
-    line_tokens_map = {i+1: [] for i in range(len(lines))}
-    
+
+    # Newline offsets, computed once: token position -> line number becomes a
+    # binary search instead of rescanning the whole prefix per token
+    newline_positions = np.array(
+        [i for i, c in enumerate(code) if c == '\n'], dtype=np.int32
+    )
+
     # Analyze key tokens: first few, then spread out to cover whole file
     # Prioritize tokens that might be confusing (operators, punctuation)
-    total = len(tokens)
+    total = len(texts)
     if total <= 10:
         analyze_indices = list(range(total))
     else:
         # First 5, last 5, and spread the middle
         analyze_indices = list(range(5)) + list(range(total-5, total))
-    
-    for idx in analyze_indices:
-        tok = tokens[idx]
+
+    # Fire all prediction requests concurrently; the semaphore caps how many
+    # are in flight at once so we don't hammer the API
+    semaphore = asyncio.Semaphore(API_CONCURRENCY)
+
+    def score_response(text: str, response: Dict) -> float:
+        """Rank the actual token against a prediction response."""
+        # Extract top predictions
+        choice = response['choices'][0]
+        logprobs_data = choice.get('logprobs', {})
+        top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
+
+        # Convert to list of {token, logprob}
+        top_list = [
+            {'token': k, 'logprob': v}
+            for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
+        ]
+
+        # Find rank of actual token
+        rank = compute_surprise_rank(text, top_list)
+        return rank_to_logprob(rank)
+
+    async def fetch_logprob(text: str, start: int) -> float:
         # Get prefix up to this token
-        prefix = code[:tok['start']]
-        
+        prefix = code[:start]
+
         # Skip if prefix is empty (first token) or too short
         if not prefix or len(prefix.strip()) == 0:
             # First token - assume confident
-            line_num = code[:tok['start']].count('\n') + 1
-            line_tokens_map[line_num].append(TokenProb(
-                token=tok['text'],
-                logprob=-0.1
-            ))
-            continue
-        
+            return -0.1
+
+        key = score_cache_key(prefix, text)
+        cached_score = SCORE_CACHE.get(key)
+        if cached_score is not None:
+            return cached_score
+
         try:
-            time.sleep(0.5)  # Rate limit: max 2 requests per second
-            response = get_next_token_prediction(prefix)
-            
-            # Extract top predictions
-            choice = response['choices'][0]
-            logprobs_data = choice.get('logprobs', {})
-            top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-            
-            # Convert to list of {token, logprob}
-            top_list = [
-                {'token': k, 'logprob': v}
-                for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-            ]
-            
-            # Find rank of actual token
-            rank = compute_surprise_rank(tok['text'], top_list)
-            fake_logprob = rank_to_logprob(rank)
-            
+            async with semaphore:
+                response = await get_next_token_prediction(prefix, CLIENT)
+            score = score_response(text, response)
+            SCORE_CACHE[key] = score
+            return score
+
         except Exception as e:
-            print(f"API error for token '{tok['text']}': {e}")
-            fake_logprob = -0.1  # Assume confident on error
-        
-        # Determine which line this token is on
-        line_num = code[:tok['start']].count('\n') + 1
-        line_tokens_map[line_num].append(TokenProb(
-            token=tok['text'],
-            logprob=fake_logprob
-        ))
-    
-    # Build FileProbs
-    line_probs_list = []
-    for i, line_content in enumerate(lines):
-        line_num = i + 1
-        line_probs_list.append(LineProbs(
-            line_number=line_num,
-            tokens=line_tokens_map.get(line_num, [])
-        ))
-    
-    return FileProbs(uri=uri, lines=line_probs_list)
+            print(f"API error for token '{text}': {e}")
+            return -0.1  # Assume confident on error
+
+    # Preferred path: one multi-prompt call covering every non-empty prefix
+    prefixes = [code[:int(starts[idx])] for idx in analyze_indices]
+    fetchable = [i for i, p in enumerate(prefixes) if p and p.strip()]
+
+    fake_logprobs = None
+    if fetchable and not MOCK_MODE:
+        # Reuse scores for tokens whose prefix is unchanged since the last
+        # analysis; only the remainder needs upstream work
+        keys = {i: score_cache_key(prefixes[i], texts[analyze_indices[i]]) for i in fetchable}
+        cached_scores = {i: SCORE_CACHE.get(keys[i]) for i in fetchable}
+        to_fetch = [i for i in fetchable if cached_scores[i] is None]
+
+        try:
+            batch = await get_batch_token_predictions(
+                [prefixes[i] for i in to_fetch], CLIENT
+            ) if to_fetch else []
+        except Exception as e:
+            print(f"Batch prediction error: {e}")
+            batch = None
+
+        if batch is not None:
+            fake_logprobs = [-0.1] * len(prefixes)
+            for i, score in cached_scores.items():
+                if score is not None:
+                    fake_logprobs[i] = score
+            for i, response in zip(to_fetch, batch):
+                if response is None:
+                    continue
+                try:
+                    fake_logprobs[i] = score_response(texts[analyze_indices[i]], response)
+                    SCORE_CACHE[keys[i]] = fake_logprobs[i]
+                except Exception as e:
+                    print(f"API error for token '{texts[analyze_indices[i]]}': {e}")
 
-@app.post("/analyze", response_model=FileProbs)
-def analyze(req: AnalyzeRequest):
+    # Fallback: concurrent per-prefix requests
+    if fake_logprobs is None:
+        fake_logprobs = await asyncio.gather(
+            *(fetch_logprob(texts[idx], int(starts[idx])) for idx in analyze_indices)
+        )
+
+    # Map all analyzed tokens to their lines in one vectorized searchsorted.
+    # analyze_indices is ascending, so line_nums comes out non-decreasing and
+    # np.split groups tokens per line without any per-token dict bookkeeping.
+    line_nums = np.searchsorted(newline_positions, starts[analyze_indices], side='right') + 1
+
+    # Plain dicts all the way down: these go straight to orjson, so paying
+    # Pydantic validation per token would be pure overhead
+    line_probs_list = [
+        {"line_number": i + 1, "tokens": []}
+        for i in range(len(lines))
+    ]
+
+    unique_lines, first_positions = np.unique(line_nums, return_index=True)
+    for line_num, group in zip(unique_lines,
+                               np.split(np.arange(len(analyze_indices)), first_positions[1:])):
+        line_probs_list[int(line_num) - 1]["tokens"] = [
+            {"token": texts[analyze_indices[j]], "logprob": fake_logprobs[j]}
+            for j in group
+        ]
+
+    return {"uri": uri, "lines": line_probs_list}
+
+@app.post("/analyze")
+async def analyze(req: AnalyzeRequest, request: Request, response: Response):
     """
     Analyze code by predicting next tokens and comparing to actual.
+
+    Responses carry an ETag derived from the code hash: a matching
+    If-None-Match header returns 304 immediately, and repolls of
+    unchanged code are served from a small result cache.
     """
-    return analyze_with_predictions(req.code, req.uri)
+    etag = hashlib.blake2b(req.code.encode(), digest_size=16).hexdigest()
+
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304)
+
+    result = ANALYZE_CACHE.get(etag)
+    if result is None:
+        result = await analyze_with_predictions(req.code, req.uri)
+        ANALYZE_CACHE[etag] = result
+    elif result.get("uri") != req.uri:
+        # Cache is keyed by content only, so identical code in another
+        # open file hits the same entry - reroute it to the requesting
+        # document instead of leaking the first file's uri
+        result = {**result, "uri": req.uri}
+
+    response.headers['ETag'] = etag
+    return result
 
 if __name__ == "__main__":
     print("=" * 60)
@@ -760,4 +1181,13 @@ if __name__ == "__main__":
         print("   Ready to analyze code with real Cerebras inference!")
     
     print("=" * 60)
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools shave ~10% each off the serving overhead; multiple
+    # workers each import this module and get their own client pool
+    uvicorn.run(
+        "api_server:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=max(2, (os.cpu_count() or 2) // 2),
+    )
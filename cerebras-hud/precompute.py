@@ -2,95 +2,314 @@
 Precompute all API responses for test_preset.py to enable instant demo.
 Run this once before the demo: python precompute.py
 """
-import json
+import argparse
+import asyncio
+import bisect
+import hashlib
 import os
-import time
-import requests
+import re
+import shelve
+from collections import Counter
+import numpy as np
+import httpx
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Optional: google-re2 scans identifiers without backtracking, which is
+# noticeably faster on large source files. Falls back to stdlib re.
+try:
+    import re2 as _re_impl
+except ImportError:
+    _re_impl = re
+
+# Compiled once at import instead of per call
+_IDENT_RE = _re_impl.compile(r'\b[a-zA-Z_][a-zA-Z0-9_]*\b')
+_TOK_RE = _re_impl.compile(r'\w+|[^\w\s]')
+
 CEREBRAS_API_URL = os.environ.get("CEREBRAS_API_URL", "https://api.cerebras.ai/v1/completions")
 CEREBRAS_API_TOKEN = os.environ.get("CEREBRAS_API_TOKEN", "")
 
-def get_prediction(prefix: str):
-    """Get prediction from Cerebras API."""
+# Max in-flight API requests during the precompute sweep
+CONCURRENCY = 8
+
+# Shared async client, opened by main() so every request reuses the
+# same connections instead of a fresh TLS handshake per call
+_CLIENT = None
+
+# Whether the upstream supports echo-mode prompt scoring; flipped off the
+# first time it's rejected so we fall back to per-token calls
+ECHO_SUPPORTED = True
+
+# In-memory memo of API responses keyed by hashed prefix. Ghost and entropy
+# for the same cursor position, and the repeated saliency baselines, now
+# reuse one response instead of re-fetching it.
+_PREDICTION_MEMO = {}
+
+# Persistent prediction cache surviving across runs. Re-running after an
+# edit to test_preset.py leaves most prefixes identical, so the second
+# run is mostly disk hits. Opened by main() unless --no-cache is given.
+CACHE_DIR = os.path.expanduser('~/.cache/cerebras_hud')
+CACHE_PATH = os.path.join(CACHE_DIR, 'predictions')
+
+_DISK_CACHE = None
+
+
+def _memo_key(prefix: str) -> str:
+    return hashlib.blake2b(prefix.encode(), digest_size=16).hexdigest()
+
+
+def _disk_key(prefix: str) -> str:
+    # Keyed by endpoint + model too, so a config change doesn't serve
+    # stale responses
+    return hashlib.blake2b(
+        (CEREBRAS_API_URL + '\x00llama-3.3-70b\x00' + prefix).encode(),
+        digest_size=16
+    ).hexdigest()
+
+
+def _cache_lookup(prefix: str):
+    """Check the in-memory memo, then the disk cache (promoting hits)."""
+    key = _memo_key(prefix)
+    data = _PREDICTION_MEMO.get(key)
+    if data is not None:
+        return data
+
+    if _DISK_CACHE is not None:
+        data = _DISK_CACHE.get(_disk_key(prefix))
+        if data is not None:
+            _PREDICTION_MEMO[key] = data
+            return data
+
+    return None
+
+
+def _cache_store(prefix: str, data):
+    """Store a response in the memo and, when enabled, on disk."""
+    _PREDICTION_MEMO[_memo_key(prefix)] = data
+    if _DISK_CACHE is not None:
+        _DISK_CACHE[_disk_key(prefix)] = data
+
+
+def _normalize_prefix(prefix: str) -> str:
+    """Normalize a prefix for deduplication.
+
+    Cursor positions that only differ by trailing spaces or trailing
+    blank lines get the same next-token prediction, so they can share
+    one API result.
+    """
+    return prefix.rstrip(' \t\n')
+
+
+async def get_prediction(prefix: str):
+    """Get prediction from Cerebras API (memoized by prefix)."""
+    cached = _cache_lookup(prefix)
+    if cached is not None:
+        return cached
+
     headers = {
         "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
         "Content-Type": "application/json",
     }
-    
+
     payload = {
         "model": "llama-3.3-70b",
         "prompt": prefix,
         "max_tokens": 1,
         "logprobs": 20,
     }
-    
-    response = requests.post(CEREBRAS_API_URL, headers=headers, json=payload)
-    
+
+    response = await _CLIENT.post(CEREBRAS_API_URL, headers=headers, json=payload)
+
+    if response.status_code != 200:
+        print(f"Error: {response.status_code} - {response.text}")
+        return None
+
+    data = orjson.loads(response.content)
+    _cache_store(prefix, data)
+    return data
+
+
+async def get_predictions(prefixes):
+    """
+    Get predictions for several prefixes in one multi-prompt API call.
+    Returns one single-choice response dict per prefix (aligned by index),
+    or None if the call failed / the server rejects list prompts.
+    """
+    # Serve cached prefixes locally; only the rest go upstream
+    results = [_cache_lookup(p) for p in prefixes]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if not missing:
+        return results
+
+    headers = {
+        "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
+        "Content-Type": "application/json",
+    }
+
+    payload = {
+        "model": "llama-3.3-70b",
+        "prompt": [prefixes[i] for i in missing],
+        "max_tokens": 1,
+        "logprobs": 20,
+    }
+
+    response = await _CLIENT.post(CEREBRAS_API_URL, headers=headers, json=payload)
+
     if response.status_code != 200:
         print(f"Error: {response.status_code} - {response.text}")
         return None
-    
-    return response.json()
+
+    data = orjson.loads(response.content)
+    for j, choice in enumerate(data.get('choices', [])):
+        idx = choice.get('index', j)
+        if idx < len(missing):
+            pos = missing[idx]
+            single = {'choices': [choice]}
+            results[pos] = single
+            _cache_store(prefixes[pos], single)
+
+    return results
+
+
+async def get_echo_logprobs(code: str):
+    """Score every prompt token in one echo-mode API call.
+
+    With echo=True and max_tokens=0 the completions endpoint returns the
+    logprobs of the prompt itself, so the whole file is scored in one
+    request instead of one per token. Returns the choice's logprobs dict
+    ('tokens', 'token_logprobs', 'text_offset', 'top_logprobs') or None
+    when echo isn't supported.
+    """
+    global ECHO_SUPPORTED
+    if not ECHO_SUPPORTED:
+        return None
+
+    headers = {
+        "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
+        "Content-Type": "application/json",
+    }
+
+    payload = {
+        "model": "llama-3.3-70b",
+        "prompt": code,
+        "max_tokens": 0,
+        "echo": True,
+        "logprobs": 20,
+    }
+
+    response = await _CLIENT.post(CEREBRAS_API_URL, headers=headers, json=payload)
+
+    if response.status_code in (400, 404, 422):
+        # Echo mode rejected - remember so we stop trying
+        ECHO_SUPPORTED = False
+        return None
+
+    if response.status_code != 200:
+        print(f"Error: {response.status_code} - {response.text}")
+        return None
+
+    data = orjson.loads(response.content)
+    logprobs_data = data.get('choices', [{}])[0].get('logprobs') or {}
+    if not logprobs_data.get('tokens'):
+        ECHO_SUPPORTED = False
+        return None
+
+    return logprobs_data
+
+
+def softmax_probs(top_logprobs):
+    """Normalize a token->logprob dict into a token->probability dict."""
+    tokens = list(top_logprobs)
+    if not tokens:
+        return {}
+
+    lp = np.fromiter(top_logprobs.values(), dtype=np.float64, count=len(tokens))
+    p = np.exp(lp - lp.max())
+    p /= p.sum()
+    return dict(zip(tokens, p.tolist()))
 
 
 def calculate_entropy(top_logprobs):
     """Calculate Shannon entropy."""
-    import math
-    
-    items = list(top_logprobs.items())
-    if not items:
+    if not top_logprobs:
         return 0.0
-    
-    max_logprob = max(v for k, v in items)
-    exps = [(k, math.exp(v - max_logprob)) for k, v in items]
-    total = sum(e for _, e in exps)
-    probs = {k: e / total for k, e in exps}
-    
-    entropy = 0.0
-    for p in probs.values():
-        if p > 0:
-            entropy -= p * math.log2(p)
-    
-    return entropy
+
+    lp = np.fromiter(top_logprobs.values(), dtype=np.float64, count=len(top_logprobs))
+    p = np.exp(lp - lp.max())
+    p /= p.sum()
+    return float(-(p * np.log2(p + 1e-30)).sum())
 
 
 def calculate_margin(top_logprobs):
     """Calculate margin between top-1 and top-2."""
-    import math
-    
-    items = sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-    if len(items) < 2:
+    if len(top_logprobs) < 2:
         return 1.0
-    
-    p1 = math.exp(items[0][1])
-    p2 = math.exp(items[1][1])
+
+    lp = np.fromiter(top_logprobs.values(), dtype=np.float64, count=len(top_logprobs))
+    top2 = np.sort(np.partition(lp, -2)[-2:])
+    p2, p1 = np.exp(top2)
     total = p1 + p2
-    return (p1 / total) - (p2 / total) if total > 0 else 0.0
+    return float((p1 - p2) / total) if total > 0 else 0.0
+
+
+def kl_missing_contrib(p_probs):
+    """KL(P || Q) assuming no P token appears in Q's top-20.
+
+    Both distributions are top-20 truncated, so most baseline tokens hit
+    the 1e-10 floor - that part only depends on P and can be computed
+    once per baseline instead of once per candidate.
+    """
+    if not p_probs:
+        return 0.0
+
+    pv = np.fromiter(p_probs.values(), dtype=np.float64, count=len(p_probs))
+    return float((pv * np.log(np.maximum(pv, 1e-30) / 1e-10)).sum())
+
+
+def kl_divergence_aligned(baseline_p, baseline_index, q_probs, missing_contrib):
+    """KL(P || Q) against a baseline pre-aligned as a probability array
+    plus token->index map, both built once and reused for every
+    candidate. Starts from the all-missing contribution and corrects
+    only tokens present in both top-20 sets (typically ~5 of 20)."""
+    indices = []
+    q_values = []
+    for token, q_prob in q_probs.items():
+        i = baseline_index.get(token)
+        if i is not None:
+            indices.append(i)
+            q_values.append(q_prob)
 
+    if not indices:
+        return missing_contrib
 
-def get_ghost_response(prefix: str):
+    pv = baseline_p[indices]
+    qv = np.asarray(q_values, dtype=np.float64)
+    delta = float((pv * np.log(1e-10 / np.maximum(qv, 1e-10))).sum())
+    return missing_contrib + delta
+
+
+async def get_ghost_response(prefix: str):
     """Get ghost token response."""
-    data = get_prediction(prefix)
+    data = await get_prediction(prefix)
     if not data:
         return None
-    
+
     choice = data['choices'][0]
     logprobs_data = choice.get('logprobs', {})
     top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-    
+
     top_list = [
         {'token': k, 'logprob': v}
         for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
     ]
-    
+
     if len(top_list) < 2:
         return None
-    
+
     margin = calculate_margin(top_logprobs)
-    
+
     return {
         'primary': top_list[0],
         'secondary': top_list[1],
@@ -99,21 +318,21 @@ def get_ghost_response(prefix: str):
     }
 
 
-def get_entropy_response(prefix: str):
+async def get_entropy_response(prefix: str):
     """Get entropy response."""
-    data = get_prediction(prefix)
+    data = await get_prediction(prefix)
     if not data:
         return None
-    
+
     choice = data['choices'][0]
     logprobs_data = choice.get('logprobs', {})
     top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-    
+
     top_list = [
         {'token': k, 'logprob': v}
         for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
     ]
-    
+
     return {
         'entropy': calculate_entropy(top_logprobs),
         'maxLogprob': top_list[0]['logprob'] if top_list else -10,
@@ -122,13 +341,51 @@ def get_entropy_response(prefix: str):
     }
 
 
-def get_saliency_response(code: str, cursor_line: int, cursor_char: int):
+async def get_combined_response(prefix: str):
+    """Derive ghost and entropy from one prediction call.
+
+    get_ghost_response and get_entropy_response consume the same
+    top_logprobs, so fetching once halves the API traffic in main().
+    The raw top_logprobs are returned too so the saliency pass can
+    reuse them as its baseline.
+    """
+    data = await get_prediction(prefix)
+    if not data:
+        return None
+
+    choice = data['choices'][0]
+    logprobs_data = choice.get('logprobs', {})
+    top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
+
+    top_list = [
+        {'token': k, 'logprob': v}
+        for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
+    ]
+
+    ghost = None
+    if len(top_list) >= 2:
+        margin = calculate_margin(top_logprobs)
+        ghost = {
+            'primary': top_list[0],
+            'secondary': top_list[1],
+            'margin': margin,
+            'shouldShowGhost': margin < 0.15
+        }
+
+    entropy = {
+        'entropy': calculate_entropy(top_logprobs),
+        'maxLogprob': top_list[0]['logprob'] if top_list else -10,
+        'topLogprobs': top_list[:10],
+        'tokenCount': len(top_list)
+    }
+
+    return {'ghost': ghost, 'entropy': entropy, 'top_logprobs_raw': top_logprobs}
+
+
+async def get_saliency_response(code: str, cursor_line: int, cursor_char: int, baseline_top_logprobs=None):
     """Get saliency by removing each token and comparing predictions."""
-    import re
-    import math
-    
     lines = code.split('\n')
-    
+
     # Build prefix up to cursor
     if cursor_line < 1:
         prefix = ""
@@ -138,32 +395,35 @@ def get_saliency_response(code: str, cursor_line: int, cursor_char: int):
         prefix_lines = lines[:cursor_line - 1]
         prefix_lines.append(lines[cursor_line - 1][:cursor_char])
         prefix = '\n'.join(prefix_lines)
-    
-    # Get baseline distribution
-    baseline_data = get_prediction(prefix)
-    if not baseline_data:
-        return None
-    
-    choice = baseline_data['choices'][0]
-    logprobs_data = choice.get('logprobs', {})
-    top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-    
-    baseline_items = list(top_logprobs.items())
-    max_logprob = max(v for k, v in baseline_items)
-    baseline_probs = {k: math.exp(v - max_logprob) for k, v in baseline_items}
-    total = sum(baseline_probs.values())
-    baseline_probs = {k: v / total for k, v in baseline_probs.items()}
-    
+
+    # Get baseline distribution, unless the caller already has it
+    if baseline_top_logprobs is not None:
+        top_logprobs = baseline_top_logprobs
+    else:
+        baseline_data = await get_prediction(prefix)
+        if not baseline_data:
+            return None
+
+        choice = baseline_data['choices'][0]
+        logprobs_data = choice.get('logprobs', {})
+        top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
+
+    baseline_probs = softmax_probs(top_logprobs)
+    # Baseline aligned once as an array + index map; every candidate
+    # below reuses it instead of re-iterating the dict
+    baseline_missing = kl_missing_contrib(baseline_probs)
+    baseline_p = np.fromiter(baseline_probs.values(), dtype=np.float64, count=len(baseline_probs))
+    baseline_index = {token: i for i, token in enumerate(baseline_probs)}
+
     # Find candidate tokens
-    identifier_pattern = re.compile(r'\b[a-zA-Z_][a-zA-Z0-9_]*\b')
     candidates = []
-    
+
     start_line = max(0, cursor_line - 5)
     end_line = min(len(lines), cursor_line + 2)
-    
+
     for line_idx in range(start_line, end_line):
         line = lines[line_idx]
-        for match in identifier_pattern.finditer(line):
+        for match in _IDENT_RE.finditer(line):
             if len(match.group()) < 2:
                 continue
             candidates.append({
@@ -171,34 +431,50 @@ def get_saliency_response(code: str, cursor_line: int, cursor_char: int):
                 'character': match.start(),
                 'token_text': match.group()
             })
-    
+
     # Limit candidates
     def distance_to_cursor(cand):
         line_dist = abs(cand['line'] - cursor_line)
         char_dist = abs(cand['character'] - cursor_char) if line_dist == 0 else 0
         return (line_dist, char_dist)
-    
-    candidates.sort(key=distance_to_cursor)
-    candidates = candidates[:10]
-    
-    # Calculate KL for each candidate
-    results = []
-    
+
+    # Rank rare identifiers first and keep one occurrence per token_text
+    # (the closest to the cursor) - perturbing a second occurrence of the
+    # same name rarely adds signal but always costs an API call
+    freq = Counter(cand['token_text'] for cand in candidates)
+    candidates.sort(key=lambda cand: (freq[cand['token_text']], distance_to_cursor(cand)))
+
+    deduped = []
+    seen_texts = set()
+    for cand in candidates:
+        if cand['token_text'] in seen_texts:
+            continue
+        seen_texts.add(cand['token_text'])
+        deduped.append(cand)
+
+    candidates = deduped[:10]
+
+    # Build every perturbed prefix first, then fetch them together:
+    # get_predictions serves cached ones locally and sends the misses as
+    # one multi-prompt call, instead of a serial await plus a flat sleep
+    # per candidate
+    pending = []
+
     for candidate in candidates:
         # Remove token
         target_line_idx = candidate['line'] - 1
         if target_line_idx < 0 or target_line_idx >= len(lines):
             continue
-        
+
         target_line = lines[target_line_idx]
         char = candidate['character']
         token_text = candidate['token_text']
         end_char = char + len(token_text)
-        
+
         new_line = target_line[:char] + target_line[end_char:]
         new_lines = lines.copy()
         new_lines[target_line_idx] = new_line
-        
+
         # Build new prefix
         if cursor_line < 1:
             new_prefix = ""
@@ -208,32 +484,32 @@ def get_saliency_response(code: str, cursor_line: int, cursor_char: int):
             new_prefix_lines = new_lines[:cursor_line - 1]
             new_prefix_lines.append(new_lines[cursor_line - 1][:cursor_char])
             new_prefix = '\n'.join(new_prefix_lines)
-        
-        # Get perturbed distribution
-        perturbed_data = get_prediction(new_prefix)
+
+        pending.append((candidate, new_prefix))
+
+    batch = await get_predictions([prefix for _, prefix in pending])
+    if batch is None:
+        # Server rejected list prompts - fall back to per-prefix calls
+        batch = [await get_prediction(prefix) for _, prefix in pending]
+
+    # Calculate KL for each candidate
+    results = []
+
+    for (candidate, _), perturbed_data in zip(pending, batch):
         if not perturbed_data:
             continue
-        
+
         choice = perturbed_data['choices'][0]
         logprobs_data = choice.get('logprobs', {})
-        top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-        
-        perturbed_items = list(top_logprobs.items())
-        if not perturbed_items:
+        perturbed_top = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
+
+        perturbed_probs = softmax_probs(perturbed_top)
+        if not perturbed_probs:
             continue
-        
-        max_logprob = max(v for k, v in perturbed_items)
-        perturbed_probs = {k: math.exp(v - max_logprob) for k, v in perturbed_items}
-        total = sum(perturbed_probs.values())
-        perturbed_probs = {k: v / total for k, v in perturbed_probs.items()}
-        
-        # Calculate KL divergence
-        kl = 0.0
-        for token, p in baseline_probs.items():
-            q = perturbed_probs.get(token, 1e-10)
-            if p > 0:
-                kl += p * math.log(p / q)
-        
+
+        # Calculate KL divergence (sparse diff against the baseline)
+        kl = kl_divergence_aligned(baseline_p, baseline_index, perturbed_probs, baseline_missing)
+
         if kl > 0.001:
             results.append({
                 'line': candidate['line'],
@@ -241,11 +517,9 @@ def get_saliency_response(code: str, cursor_line: int, cursor_char: int):
                 'tokenText': candidate['token_text'],
                 'klDivergence': kl
             })
-        
-        time.sleep(0.1)  # Rate limiting
-    
+
     results.sort(key=lambda x: x['klDivergence'], reverse=True)
-    
+
     return {
         'tokens': results[:10],
         'baseEntropy': calculate_entropy(top_logprobs)
@@ -254,10 +528,8 @@ def get_saliency_response(code: str, cursor_line: int, cursor_char: int):
 
 def tokenize_simple(code: str):
     """Simple tokenizer."""
-    import re
     tokens = []
-    pos = 0
-    for match in re.finditer(r'\w+|[^\w\s]', code):
+    for match in _TOK_RE.finditer(code):
         tokens.append({
             'text': match.group(),
             'start': match.start(),
@@ -266,85 +538,154 @@ def tokenize_simple(code: str):
     return tokens
 
 
-def compute_token_ranks(code: str):
+async def compute_token_ranks(code: str):
     """Compute rank for each token in the code."""
-    import math
-    
     tokens = tokenize_simple(code)
     results = []
-    
-    for i, tok in enumerate(tokens):
-        # Get prefix up to this token
-        prefix = code[:tok['start']]
-        
-        if not prefix.strip():
-            # First token
-            results.append({
-                'token': tok['text'],
-                'position': tok['start'],
-                'logprob': -0.1,
-                'rank': 1,
-                'isInTop5': True
-            })
-            continue
-        
-        print(f"  Analyzing token {i+1}/{len(tokens)}: '{tok['text']}'")
-        
-        data = get_prediction(prefix)
-        if not data:
-            results.append({
-                'token': tok['text'],
-                'position': tok['start'],
-                'logprob': -0.1,
-                'rank': 1,
-                'isInTop5': True
-            })
-            time.sleep(0.5)
-            continue
-        
+
+    def default_result(tok):
+        return {
+            'token': tok['text'],
+            'position': tok['start'],
+            'logprob': -0.1,
+            'rank': 1,
+            'isInTop5': True
+        }
+
+    def result_from_data(tok, data):
         choice = data['choices'][0]
         logprobs_data = choice.get('logprobs', {})
         top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-        
+
         # Find rank of actual token
         actual_token = tok['text']
         rank = -1
         top_list = sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-        
+
         for idx, (predicted_token, logprob) in enumerate(top_list):
             if predicted_token.strip() == actual_token.strip():
                 rank = idx + 1
                 actual_logprob = logprob
                 break
-        
+
         if rank == -1:
             rank = 6  # Not in top 5
             actual_logprob = -5.0
-        
-        results.append({
+
+        return {
             'token': actual_token,
             'position': tok['start'],
             'logprob': actual_logprob,
             'rank': rank,
             'isInTop5': rank <= 5
-        })
-        
-        time.sleep(0.5)  # Rate limiting between tokens
-    
+        }
+
+    # Fast path: one echo-mode call scores every token in the file
+    echo_logprobs = await get_echo_logprobs(code)
+    if echo_logprobs is not None:
+        offsets = echo_logprobs.get('text_offset', [])
+        token_logprobs = echo_logprobs.get('token_logprobs', [])
+        top_logprobs_list = echo_logprobs.get('top_logprobs', [])
+
+        for tok in tokens:
+            if not code[:tok['start']].strip():
+                # First token
+                results.append(default_result(tok))
+                continue
+
+            # Model token covering this character offset
+            i = bisect.bisect_right(offsets, tok['start']) - 1 if offsets else -1
+
+            actual_logprob = None
+            top_logprobs = {}
+            if 0 <= i < len(token_logprobs):
+                actual_logprob = token_logprobs[i]
+                if i < len(top_logprobs_list) and top_logprobs_list[i]:
+                    top_logprobs = top_logprobs_list[i]
+
+            # Find rank of actual token among the alternatives
+            rank = -1
+            top_list = sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
+            for idx, (predicted_token, logprob) in enumerate(top_list):
+                if predicted_token.strip() == tok['text'].strip():
+                    rank = idx + 1
+                    actual_logprob = logprob
+                    break
+
+            if rank == -1:
+                rank = 6  # Not in top 5
+                if actual_logprob is None:
+                    actual_logprob = -5.0
+
+            results.append({
+                'token': tok['text'],
+                'position': tok['start'],
+                'logprob': actual_logprob,
+                'rank': rank,
+                'isInTop5': rank <= 5
+            })
+
+        return results
+
+    # Tokens with an empty prefix get a default; the rest are batched
+    pending = []  # (slot in results, tok, prefix)
+    for tok in tokens:
+        prefix = code[:tok['start']]
+        if not prefix.strip():
+            # First token
+            results.append(default_result(tok))
+            continue
+        results.append(None)
+        pending.append((len(results) - 1, tok, prefix))
+
+    # One multi-prompt call per chunk instead of one call per token
+    batch_size = 20
+    for chunk_start in range(0, len(pending), batch_size):
+        chunk = pending[chunk_start:chunk_start + batch_size]
+        # Progress every 5 batches; per-iteration prints flush the stream
+        # each call, which adds up inside a hot loop
+        if chunk_start % (batch_size * 5) == 0:
+            print(f"  Analyzing tokens {chunk_start + 1}-{chunk_start + len(chunk)}/{len(pending)}")
+
+        batch = await get_predictions([prefix for _, _, prefix in chunk])
+        if batch is None:
+            # Server rejected list prompts - fall back to per-prefix calls
+            batch = [await get_prediction(prefix) for _, _, prefix in chunk]
+
+        for (slot, tok, _), data in zip(chunk, batch):
+            results[slot] = result_from_data(tok, data) if data else default_result(tok)
+
+        await asyncio.sleep(0.5)  # Rate limiting between batches
+
     return results
 
 
-def main():
+async def main():
+    global _CLIENT, _DISK_CACHE
+
+    parser = argparse.ArgumentParser(description='Precompute API responses for test_preset.py')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='skip the on-disk prediction cache for this run')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='start from an empty on-disk prediction cache')
+    parser.add_argument('--dense', action='store_true',
+                        help='query every character position instead of token boundaries')
+    args = parser.parse_args()
+
+    if not args.no_cache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _DISK_CACHE = shelve.open(CACHE_PATH, 'n' if args.clear_cache else 'c')
+
     print("=" * 60)
     print("Precomputing API responses for test_preset.py")
     print("=" * 60)
-    
+
     # Read test_preset.py
     with open('/home/amitav-krishna/codage/projets/cerebras-challenge/test_preset.py', 'r') as f:
         code = f.read()
-    
+
     print(f"\nCode to precompute:\n{code}\n")
-    
+
     precomputed = {
         'code': code,
         'token_ranks': [],
@@ -352,59 +693,147 @@ def main():
         'entropies': {},  # key: "line:char" -> entropy data
         'saliencies': {}  # key: "line:char" -> saliency data
     }
-    
+
     lines = code.split('\n')
-    
-    # 1. Compute token ranks (for the /analyze endpoint)
-    print("\n[1/4] Computing token ranks...")
-    precomputed['token_ranks'] = compute_token_ranks(code)
-    
-    # 2. Compute ghost and entropy for every cursor position
-    print("\n[2/4] Computing ghost tokens and entropy...")
-    
-    for line_idx, line in enumerate(lines):
-        line_num = line_idx + 1
-        for char_pos in range(len(line) + 1):
+
+    client_limits = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+    async with httpx.AsyncClient(http2=True, timeout=30, limits=client_limits) as client:
+        _CLIENT = client
+
+        # 1. Compute token ranks (for the /analyze endpoint)
+        print("\n[1/4] Computing token ranks...")
+        precomputed['token_ranks'] = await compute_token_ranks(code)
+
+        # 2. Compute ghost and entropy for every cursor position
+        print("\n[2/4] Computing ghost tokens and entropy...")
+
+        # Absolute offset of each line's first character, computed once so
+        # every prefix is a single slice of code rather than a split/join
+        # per position (O(N) work x thousands of positions)
+        line_offsets = [0] + [i + 1 for i, c in enumerate(code) if c == '\n']
+
+        # Cursor positions worth querying: token boundaries plus line
+        # start/end. Adjacent positions inside a token yield the same
+        # next-token prediction, so the per-character sweep (kept behind
+        # --dense) mostly re-fetches identical results.
+        if args.dense:
+            positions_per_line = {
+                line_idx: range(len(line) + 1)
+                for line_idx, line in enumerate(lines)
+            }
+        else:
+            boundary_sets = {
+                line_idx: {0, len(line)} for line_idx, line in enumerate(lines)
+            }
+            for tok in tokenize_simple(code):
+                for offset in (tok['start'], tok['end']):
+                    line_idx = bisect.bisect_right(line_offsets, offset) - 1
+                    boundary_sets[line_idx].add(offset - line_offsets[line_idx])
+            positions_per_line = {
+                line_idx: sorted(chars) for line_idx, chars in boundary_sets.items()
+            }
+
+        # Build every (key, prefix) up front, then fetch them all
+        # concurrently under a semaphore instead of one serial call
+        # plus sleep per position
+        position_prefixes = []
+        for line_idx, line in enumerate(lines):
+            line_num = line_idx + 1
+            line_start = line_offsets[line_idx]
+            for char_pos in positions_per_line[line_idx]:
+                key = f"{line_num}:{char_pos}"
+                position_prefixes.append((key, code[:line_start + char_pos]))
+
+        # Dedup equivalent prefixes: whitespace-only cursor moves map to
+        # the same normalized prefix, so only the first occurrence hits
+        # the API and the rest copy its results
+        seen = {}        # normalized prefix -> first key that produced it
+        duplicates = []  # (key, key to copy from)
+        unique_positions = []
+        for key, prefix in position_prefixes:
+            norm = _normalize_prefix(prefix)
+            first_key = seen.get(norm)
+            if first_key is not None:
+                duplicates.append((key, first_key))
+            else:
+                seen[norm] = key
+                unique_positions.append((key, prefix))
+
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+
+        async def bounded_combined(key, prefix):
+            async with semaphore:
+                combined = await get_combined_response(prefix)
+                # Pace requests while holding the slot so the server
+                # sees at most CONCURRENCY/0.2 req/s
+                await asyncio.sleep(0.2)
+            return key, combined
+
+        fetched = await asyncio.gather(
+            *(bounded_combined(key, prefix) for key, prefix in unique_positions)
+        )
+
+        # Raw top_logprobs per position, reused as saliency baselines below
+        baseline_raw = {}
+
+        for key, combined in fetched:
+            if combined:
+                if combined['ghost']:
+                    precomputed['ghosts'][key] = combined['ghost']
+                precomputed['entropies'][key] = combined['entropy']
+                baseline_raw[key] = combined['top_logprobs_raw']
+
+        # Fill in the deduplicated positions from their first occurrence
+        for key, first_key in duplicates:
+            if first_key in precomputed['ghosts']:
+                precomputed['ghosts'][key] = precomputed['ghosts'][first_key]
+            if first_key in precomputed['entropies']:
+                precomputed['entropies'][key] = precomputed['entropies'][first_key]
+            if first_key in baseline_raw:
+                baseline_raw[key] = baseline_raw[first_key]
+
+        total_positions = len(position_prefixes)
+        print(f"  {total_positions} cursor positions done "
+              f"({len(duplicates)} served by dedup, "
+              f"{100 * len(duplicates) // max(total_positions, 1)}% hit rate)")
+
+        # 3. Compute saliency for key positions
+        print("\n[3/4] Computing saliency...")
+
+        # Saliency at end of each line. Lines are independent HTTP-bound
+        # work, so run several concurrently instead of one line per
+        # 0.5 s; each line still paces its own candidate fetches.
+        saliency_semaphore = asyncio.Semaphore(4)
+
+        async def bounded_saliency(line_num, char_pos):
             key = f"{line_num}:{char_pos}"
-            
-            # Build prefix
-            prefix_lines = lines[:line_idx]
-            prefix_lines.append(line[:char_pos])
-            prefix = '\n'.join(prefix_lines)
-            
-            ghost = get_ghost_response(prefix)
-            if ghost:
-                precomputed['ghosts'][key] = ghost
-            
-            entropy = get_entropy_response(prefix)
-            if entropy:
-                precomputed['entropies'][key] = entropy
-            
-            time.sleep(0.2)
-        
-        print(f"  Line {line_num}/{len(lines)} done")
-    
-    # 3. Compute saliency for key positions
-    print("\n[3/4] Computing saliency...")
-    
-    # Saliency at end of each line
-    for line_idx, line in enumerate(lines):
-        line_num = line_idx + 1
-        char_pos = len(line)
-        key = f"{line_num}:{char_pos}"
-        
-        saliency = get_saliency_response(code, line_num, char_pos)
-        if saliency:
-            precomputed['saliencies'][key] = saliency
-        
-        print(f"  Saliency for line {line_num} done")
-        time.sleep(0.5)
-    
+            async with saliency_semaphore:
+                saliency = await get_saliency_response(
+                    code, line_num, char_pos,
+                    baseline_top_logprobs=baseline_raw.get(key)
+                )
+            return key, saliency
+
+        line_results = await asyncio.gather(*(
+            bounded_saliency(line_idx + 1, len(line))
+            for line_idx, line in enumerate(lines)
+        ))
+
+        for key, saliency in line_results:
+            if saliency:
+                precomputed['saliencies'][key] = saliency
+
+        print(f"  Saliency done for {len(lines)} lines")
+
+    if _DISK_CACHE is not None:
+        _DISK_CACHE.close()
+        _DISK_CACHE = None
+
     # Save to file
     output_path = '/home/amitav-krishna/codage/projets/cerebras-challenge/cerebras-hud/precomputed.json'
-    with open(output_path, 'w') as f:
-        json.dump(precomputed, f, indent=2)
-    
+    with open(output_path, 'wb') as f:
+        f.write(orjson.dumps(precomputed, option=orjson.OPT_INDENT_2))
+
     print(f"\n[4/4] Saved precomputed data to {output_path}")
     print(f"  - {len(precomputed['token_ranks'])} token ranks")
     print(f"  - {len(precomputed['ghosts'])} ghost positions")
@@ -416,4 +845,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
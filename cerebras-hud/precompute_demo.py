@@ -2,17 +2,99 @@
 Precompute ALL data for the demo script.
 This ensures instant playback without any API calls during the demo.
 """
-import json
+import asyncio
+import hashlib
 import os
+import re
 import time
-import requests
+import numpy as np
+import httpx
+import orjson
 from dotenv import load_dotenv
 
+# msgpack output is much smaller and faster to reload than indented
+# JSON; fall back to JSON when it isn't installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 load_dotenv()
 
 CEREBRAS_API_URL = os.environ.get("CEREBRAS_API_URL", "https://api.cerebras.ai/v1/completions")
 CEREBRAS_API_TOKEN = os.environ.get("CEREBRAS_API_TOKEN", "")
 
+# One keep-alive async client shared by all in-flight requests: reusing
+# connections drops the per-call TCP+TLS handshake, and everything runs
+# on a single thread instead of a pool of blocked workers
+_CLIENT = None
+
+# Append-only checkpoint: every successful prediction is flushed as one
+# JSON line, so a crashed or interrupted run resumes without re-paying
+# any API call - the file doubles as the persistent prediction cache
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+CHECKPOINT_PATH = os.path.join(CACHE_DIR, 'demo_checkpoint.jsonl')
+
+_PREDICTION_MEMO = {}
+_CHECKPOINT_FILE = None
+
+# Max requests in flight at once; calls are network-bound so the event
+# loop spends almost all its time in I/O wait
+MAX_IN_FLIGHT = 8
+
+# Prefixes per multi-prompt request - the endpoint batches them
+# on-device, amortizing per-request overhead
+BATCH_SIZE = 16
+
+# Batches buffered ahead of the workers by the dispatch queue
+QUEUE_DEPTH = 64
+
+# Global request pacing shared by all in-flight tasks
+REQUESTS_PER_SECOND = 4.0
+
+# Transient statuses worth retrying with backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 5
+
+
+class RateLimiter:
+    """Space request start times so all tasks together stay under
+    `rate` requests per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = asyncio.Lock()
+        self.next_time = 0.0
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+RATE_LIMITER = RateLimiter(REQUESTS_PER_SECOND)
+
+
+def _cache_key(prefix: str) -> str:
+    # rstrip'ing the key buckets prefixes that differ only by trailing
+    # whitespace - the model sees effectively the same context, so they
+    # share one cached prediction (same normalization precompute.py uses
+    # for its dedup). blake2b is faster than sha256 on CPython.
+    return hashlib.blake2b(prefix.rstrip().encode(), digest_size=16).hexdigest()
+
+# Word-or-punctuation tokenizer for the token-rank pass, compiled once
+TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+# Everything but the prompt is identical across requests
+_PAYLOAD_TEMPLATE = {
+    "model": "llama-3.3-70b",
+    "max_tokens": 1,
+    "logprobs": 20,
+}
+
 # The exact code that will be typed in the demo
 DEMO_CODE_STATES = [
     # Progressive states
@@ -41,138 +123,296 @@ def analyze(data):
     return result""",
 ]
 
-def get_prediction(prefix: str):
-    """Get prediction from Cerebras API."""
-    if not prefix.strip():
-        return None
-        
-    headers = {
-        "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    
-    payload = {
-        "model": "llama-3.3-70b",
-        "prompt": prefix,
-        "max_tokens": 1,
-        "logprobs": 20,
-    }
-    
-    try:
-        response = requests.post(CEREBRAS_API_URL, headers=headers, json=payload)
-        if response.status_code == 200:
-            return response.json()
-        else:
+async def get_predictions(batch):
+    """Get predictions for a batch of prefixes in one multi-prompt call.
+
+    The endpoint accepts a list prompt; the response's choices align
+    index-for-index with the input, so up to BATCH_SIZE prefixes cost a
+    single request. Returns one single-choice response dict per prefix
+    (memoized and checkpointed), or None where the call failed or the
+    prefix is blank. Cache hits are served locally; only the rest go
+    upstream, through the shared rate limiter with backoff on 429/5xx.
+    """
+    results = [_PREDICTION_MEMO.get(_cache_key(p)) if p.strip() else None
+               for p in batch]
+    missing = [i for i, r in enumerate(results)
+               if r is None and batch[i].strip()]
+    if not missing:
+        return results
+
+    # Serialize once up front - retries resend the same bytes, and the
+    # shared client already carries the auth/content-type headers
+    body = orjson.dumps({
+        **_PAYLOAD_TEMPLATE,
+        "prompt": [batch[i] for i in missing],
+    })
+
+    data = None
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            await RATE_LIMITER.acquire()
+            response = await _CLIENT.post(CEREBRAS_API_URL, content=body)
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                break
+            if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                # Obey the server's Retry-After if it sent one; otherwise
+                # back off exponentially, capped so a long outage doesn't
+                # stall a task for minutes
+                try:
+                    delay = float(response.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    delay = min(2.0 ** attempt, 30.0)
+                await asyncio.sleep(delay)
+                continue
             print(f"  Error {response.status_code}: {response.text[:100]}")
-            return None
-    except Exception as e:
-        print(f"  Exception: {e}")
-        return None
-
-def calculate_entropy(top_logprobs):
-    """Calculate Shannon entropy."""
-    import math
-    
-    items = list(top_logprobs.items())
-    if not items:
-        return 0.0
-    
-    max_logprob = max(v for k, v in items)
-    exps = [(k, math.exp(v - max_logprob)) for k, v in items]
-    total = sum(e for _, e in exps)
-    probs = {k: e / total for k, e in exps}
-    
-    entropy = 0.0
-    for p in probs.values():
-        if p > 0:
-            entropy -= p * math.log2(p)
-    
-    return entropy
+        except Exception as e:
+            print(f"  Exception: {e}")
+        break
 
-def calculate_margin(top_logprobs):
-    """Calculate margin between top-1 and top-2."""
-    import math
-    
-    items = sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-    if len(items) < 2:
-        return 1.0
-    
-    p1 = math.exp(items[0][1])
-    p2 = math.exp(items[1][1])
-    total = p1 + p2
-    return (p1 / total) - (p2 / total) if total > 0 else 0.0
+    if data is None:
+        return results
+
+    for j, choice in enumerate(data.get('choices', [])):
+        idx = choice.get('index', j)
+        if idx >= len(missing):
+            continue
+        pos = missing[idx]
+        single = {'choices': [choice]}
+        results[pos] = single
+        key = _cache_key(batch[pos])
+        _PREDICTION_MEMO[key] = single
+        if _CHECKPOINT_FILE is not None:
+            # Flush per result so at most one in-flight batch is lost on crash
+            _CHECKPOINT_FILE.write(orjson.dumps({"key": key, "data": single}) + b'\n')
+            _CHECKPOINT_FILE.flush()
+
+    return results
+
+
+def load_checkpoint():
+    """Preload checkpointed predictions from a previous (partial) run."""
+    if not os.path.exists(CHECKPOINT_PATH):
+        return 0
+    loaded = 0
+    with open(CHECKPOINT_PATH, 'rb') as f:
+        for line in f:
+            try:
+                record = orjson.loads(line)
+            except ValueError:
+                continue  # truncated tail from a crash mid-write
+            _PREDICTION_MEMO[record["key"]] = record["data"]
+            loaded += 1
+    return loaded
+
+
+async def fetch_predictions(prefixes):
+    """Fetch many prefixes concurrently; returns {prefix: data-or-None}.
+
+    Duplicates are collapsed first, then a producer chunks the unique
+    prefixes into multi-prompt batches and feeds a bounded queue drained
+    by a fixed pool of workers - the producer stays ahead of the network
+    so workers never idle waiting for work, and the queue cap keeps the
+    pending set small instead of materializing every batch task up front.
+    """
+    unique = list(dict.fromkeys(prefixes))
+    queue = asyncio.Queue(maxsize=QUEUE_DEPTH)
+    results = {}
+
+    async def produce():
+        for i in range(0, len(unique), BATCH_SIZE):
+            await queue.put(unique[i:i + BATCH_SIZE])
+        for _ in range(MAX_IN_FLIGHT):
+            await queue.put(None)  # one stop signal per worker
+
+    async def consume():
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return
+            res = await get_predictions(batch)
+            results.update(zip(batch, res))
+
+    await asyncio.gather(produce(),
+                         *(consume() for _ in range(MAX_IN_FLIGHT)))
+    return results
+
+def summarize(top_logprobs):
+    """Summarize a top-logprobs dict in one vectorized pass.
+
+    Returns entropy, top-1/top-2 margin, and the ranked
+    [{'token', 'logprob'}, ...] list - the softmax and sort are computed
+    once instead of separately per metric.
+    """
+    keys = list(top_logprobs)
+    if not keys:
+        return {'entropy': 0.0, 'margin': 1.0, 'top': []}
+
+    v = np.fromiter(top_logprobs.values(), dtype=np.float64, count=len(keys))
+    order = np.argsort(-v)
+
+    p = np.exp(v - v.max())
+    p /= p.sum()
+    entropy = float(-(p * np.log2(p + 1e-30)).sum())
+
+    if len(keys) >= 2:
+        margin = float(p[order[0]] - p[order[1]])
+    else:
+        margin = 1.0
+
+    top = [{'token': keys[idx], 'logprob': float(v[idx])} for idx in order]
+    return {'entropy': entropy, 'margin': margin, 'top': top}
+
+def _line_starts(lines):
+    """Absolute offset of each line's first character in the joined code."""
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line) + 1)
+    return starts
+
+
+def state_positions(code):
+    """Enumerate the (key, prefix) pairs precomputed for one demo state."""
+    lines = code.split('\n')
+
+    # Precompute for key positions in this state
+    positions_to_compute = []
+
+    # End of each line
+    for line_idx, line in enumerate(lines):
+        positions_to_compute.append((line_idx + 1, len(line)))
+
+    # Some intermediate positions
+    for line_idx, line in enumerate(lines):
+        if len(line) > 5:
+            positions_to_compute.append((line_idx + 1, len(line) // 2))
+
+    # Remove duplicates
+    positions_to_compute = sorted(set(positions_to_compute))
+
+    line_starts = _line_starts(lines)
+
+    items = []
+    for line_num, char_pos in positions_to_compute:
+        # Prefix is a single slice of the full code
+        prefix = code[:line_starts[line_num - 1] + char_pos]
+
+        if not prefix.strip():
+            continue
+
+        items.append((f"{line_num}:{char_pos}", prefix))
+
+    return items
+
+
+def sweep_positions(final_code):
+    """Enumerate (line_num, key, prefix) for every final-code position."""
+    lines = final_code.split('\n')
+    line_starts = _line_starts(lines)
+    items = []
+    for line_idx, line in enumerate(lines):
+        line_num = line_idx + 1
+        for char_pos in range(len(line) + 1):
+            # Single slice instead of rejoining the line list every time
+            prefix = final_code[:line_starts[line_idx] + char_pos]
+
+            if not prefix.strip():
+                continue
+
+            items.append((line_num, f"{line_num}:{char_pos}", prefix))
+
+    return items
+
+
+async def main():
+    global _CLIENT, _CHECKPOINT_FILE
 
-def main():
     print("=" * 70)
     print("Precomputing ALL Demo Data")
     print("=" * 70)
-    
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    resumed = load_checkpoint()
+    if resumed:
+        print(f"Resumed {resumed} predictions from {CHECKPOINT_PATH}")
+    _CHECKPOINT_FILE = open(CHECKPOINT_PATH, 'ab')
+
+    _CLIENT = httpx.AsyncClient(
+        headers={
+            "Authorization": f"Bearer {CEREBRAS_API_TOKEN}",
+            "Content-Type": "application/json",
+        },
+        timeout=30,
+        limits=httpx.Limits(max_connections=MAX_IN_FLIGHT,
+                            max_keepalive_connections=MAX_IN_FLIGHT),
+        http2=True,
+    )
+
     precomputed = {
         "version": "1.0",
         "description": "Precomputed data for Cerebras HUD demo",
         "states": {}
     }
-    
-    # For each code state, precompute data at various cursor positions
+
+    final_code = DEMO_CODE_STATES[-1]
+
+    # Enumerate every prefix we will need - per-state positions, token-rank
+    # prefixes, and the full final-code sweep - before any fetch. The
+    # progressive states repeat earlier states' prefixes verbatim and the
+    # sweep covers most of them again, so one deduplicated dispatch fetches
+    # each unique prefix exactly once.
+    state_items = [state_positions(code) for code in DEMO_CODE_STATES]
+
+    tokens = []
+    for match in TOKEN_RE.finditer(final_code):
+        tokens.append({
+            'text': match.group(),
+            'start': match.start(),
+            'end': match.end()
+        })
+
+    sweep_items = sweep_positions(final_code)
+
+    all_prefixes = []
+    for items in state_items:
+        all_prefixes.extend(prefix for _, prefix in items)
+    all_prefixes.extend(final_code[:tok['start']] for tok in tokens)
+    all_prefixes.extend(prefix for _, _, prefix in sweep_items)
+
+    unique_count = len(dict.fromkeys(all_prefixes))
+    state_prefix_set = {prefix for items in state_items for _, prefix in items}
+    subsumed = sum(1 for _, _, prefix in sweep_items if prefix in state_prefix_set)
+    print(f"\n{len(all_prefixes)} prefixes total, {unique_count} unique - fetching...")
+    print(f"  ({subsumed}/{len(sweep_items)} sweep positions already covered by state positions)")
+    predictions = await fetch_predictions(all_prefixes)
+
+    # For each code state, materialize data at various cursor positions
     for i, code in enumerate(DEMO_CODE_STATES):
         print(f"\n[{i+1}/{len(DEMO_CODE_STATES)}] Processing code state:")
         print(f"  {code[:50].replace(chr(10), ' ')}...")
-        
+
         state_data = {
             "code": code,
             "positions": {}
         }
-        
-        lines = code.split('\n')
-        
-        # Precompute for key positions in this state
-        positions_to_compute = []
-        
-        # End of each line
-        for line_idx, line in enumerate(lines):
-            positions_to_compute.append((line_idx + 1, len(line)))
-        
-        # Some intermediate positions
-        for line_idx, line in enumerate(lines):
-            if len(line) > 5:
-                positions_to_compute.append((line_idx + 1, len(line) // 2))
-        
-        # Remove duplicates
-        positions_to_compute = list(set(positions_to_compute))
-        positions_to_compute.sort()
-        
-        for line_num, char_pos in positions_to_compute:
-            key = f"{line_num}:{char_pos}"
-            
-            # Build prefix
-            prefix_lines = lines[:line_num - 1]
-            if line_num <= len(lines):
-                prefix_lines.append(lines[line_num - 1][:char_pos])
-            prefix = '\n'.join(prefix_lines)
-            
-            if not prefix.strip():
-                continue
-            
-            print(f"    Computing position {key}...", end=' ', flush=True)
-            
-            # Get prediction
-            data = get_prediction(prefix)
-            
+
+        for key, prefix in state_items[i]:
+            print(f"    Position {key}...", end=' ', flush=True)
+            data = predictions[prefix]
+
             if data:
                 choice = data['choices'][0]
                 logprobs_data = choice.get('logprobs', {})
                 top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-                
-                top_list = [
-                    {'token': k, 'logprob': v}
-                    for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-                ]
-                
+
+                summary = summarize(top_logprobs)
+                top_list = summary['top']
+
                 if len(top_list) >= 2:
-                    margin = calculate_margin(top_logprobs)
-                    
+                    margin = summary['margin']
+
                     state_data["positions"][key] = {
-                        "entropy": calculate_entropy(top_logprobs),
+                        "entropy": summary['entropy'],
                         "maxLogprob": top_list[0]['logprob'] if top_list else -10,
                         "topLogprobs": top_list[:10],
                         "tokenCount": len(top_list),
@@ -186,38 +426,23 @@ def main():
                     print("NO_DATA")
             else:
                 print("FAILED")
-            
-            # Rate limiting
-            time.sleep(0.3)
-        
+
         precomputed["states"][f"state_{i}"] = state_data
     
-    # Also precompute for the full final code at every position
+    # Also materialize for the full final code at every position
     print("\n" + "=" * 70)
-    print("Precomputing full code at EVERY cursor position...")
+    print("Materializing full code at EVERY cursor position...")
     print("=" * 70)
-    
-    final_code = DEMO_CODE_STATES[-1]
-    lines = final_code.split('\n')
-    
+
     full_precomputed = {
         "code": final_code,
         "ghosts": {},
         "entropies": {},
         "token_ranks": []
     }
-    
+
     # Token ranks for final code
     print("\nComputing token ranks...")
-    import re
-    tokens = []
-    for match in re.finditer(r'\w+|[^\w\s]', final_code):
-        tokens.append({
-            'text': match.group(),
-            'start': match.start(),
-            'end': match.end()
-        })
-    
     for j, tok in enumerate(tokens):
         prefix = final_code[:tok['start']]
         if not prefix.strip():
@@ -229,23 +454,23 @@ def main():
                 'isInTop5': True
             })
             continue
-        
+
         print(f"  Token {j+1}/{len(tokens)}: {tok['text'][:20]}", end=' ', flush=True)
-        
-        data = get_prediction(prefix)
+
+        data = predictions[prefix]
         if data:
             choice = data['choices'][0]
             logprobs_data = choice.get('logprobs', {})
             top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-            
-            top_list = sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-            
+
+            top_list = summarize(top_logprobs)['top']
+
             rank = -1
             logprob = -5.0
-            for idx, (predicted, lp) in enumerate(top_list):
-                if predicted.strip() == tok['text'].strip():
+            for idx, entry in enumerate(top_list):
+                if entry['token'].strip() == tok['text'].strip():
                     rank = idx + 1
-                    logprob = lp
+                    logprob = entry['logprob']
                     break
             
             if rank == -1:
@@ -268,61 +493,53 @@ def main():
                 'isInTop5': True
             })
             print("FAILED (using default)")
-        
-        time.sleep(0.5)
-    
+
     # Ghost and entropy for every position in final code
     print("\nComputing ghost and entropy for all positions...")
-    for line_idx, line in enumerate(lines):
-        line_num = line_idx + 1
-        for char_pos in range(len(line) + 1):
-            key = f"{line_num}:{char_pos}"
-            
-            prefix_lines = lines[:line_idx]
-            prefix_lines.append(line[:char_pos])
-            prefix = '\n'.join(prefix_lines)
-            
-            if not prefix.strip():
-                continue
-            
-            data = get_prediction(prefix)
-            if data:
-                choice = data['choices'][0]
-                logprobs_data = choice.get('logprobs', {})
-                top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
-                
-                top_list = [
-                    {'token': k, 'logprob': v}
-                    for k, v in sorted(top_logprobs.items(), key=lambda x: x[1], reverse=True)
-                ]
-                
-                if len(top_list) >= 2:
-                    margin = calculate_margin(top_logprobs)
-                    
-                    full_precomputed["ghosts"][key] = {
-                        "primary": top_list[0],
-                        "secondary": top_list[1],
-                        "margin": margin,
-                        "shouldShowGhost": margin < 0.15
-                    }
-                    
-                    full_precomputed["entropies"][key] = {
-                        "entropy": calculate_entropy(top_logprobs),
-                        "maxLogprob": top_list[0]['logprob'],
-                        "topLogprobs": top_list[:10]
-                    }
-            
-            time.sleep(0.2)
-        
-        print(f"  Line {line_num}/{len(lines)} done")
-    
+
+    for line_num, key, prefix in sweep_items:
+        data = predictions[prefix]
+        if data:
+            choice = data['choices'][0]
+            logprobs_data = choice.get('logprobs', {})
+            top_logprobs = logprobs_data.get('top_logprobs', [{}])[0] if logprobs_data.get('top_logprobs') else {}
+
+            summary = summarize(top_logprobs)
+            top_list = summary['top']
+
+            if len(top_list) >= 2:
+                margin = summary['margin']
+
+                full_precomputed["ghosts"][key] = {
+                    "primary": top_list[0],
+                    "secondary": top_list[1],
+                    "margin": margin,
+                    "shouldShowGhost": margin < 0.15
+                }
+
+                full_precomputed["entropies"][key] = {
+                    "entropy": summary['entropy'],
+                    "maxLogprob": top_list[0]['logprob'],
+                    "topLogprobs": top_list[:10]
+                }
+
+    print(f"  {len(sweep_items)} positions done")
+
+
     # Save everything
-    output_path = '/home/amitav-krishna/codage/projets/cerebras-challenge/cerebras-hud/demo_precomputed.json'
-    with open(output_path, 'w') as f:
-        json.dump({
-            "demo_states": precomputed,
-            "full_code": full_precomputed
-        }, f, indent=2)
+    output = {
+        "demo_states": precomputed,
+        "full_code": full_precomputed
+    }
+    output_dir = '/home/amitav-krishna/codage/projets/cerebras-challenge/cerebras-hud'
+    if msgpack is not None:
+        output_path = os.path.join(output_dir, 'demo_precomputed.msgpack')
+        with open(output_path, 'wb') as f:
+            f.write(msgpack.packb(output, use_bin_type=True))
+    else:
+        output_path = os.path.join(output_dir, 'demo_precomputed.json')
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
     
     print("\n" + "=" * 70)
     print(f"Saved to: {output_path}")
@@ -332,5 +549,8 @@ def main():
     print(f"  - {len(full_precomputed['entropies'])} entropy positions")
     print("=" * 70)
 
+    _CHECKPOINT_FILE.close()
+    await _CLIENT.aclose()
+
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())